@@ -2,11 +2,18 @@
 
 import argparse
 from pathlib import Path
-import subprocess
 import sys
+import json
+import hashlib
+from os import environ
+from shutil import copyfile
+from concurrent.futures import ThreadPoolExecutor
 import scripts.templates
-from scripts.templates import P2020, MPC5777M, CORES, TOP_DIR, PSY_DIR, STUBS_DIR, SRC_DIR, CFG_DIR, Help, AGENT_CONFIG_HJSON_TEMPLATE, CORUNNER_CONFIG_HJSON_TEMPLATE, CORUNNER_KMEMORY_JSON_TEMPLATE, COMPILE_CONFIG_HJSON_TEMPLATE, PSYMODULE_CONFIG_HJSON_TEMPLATE, FLASHLIKE
-from scripts.scriptutil import load_db, load_json, dump_json, write_template, psyko
+from scripts.templates import P2020, MPC5777M, CORES, TOP_DIR, PSY_DIR, STUBS_DIR, SRC_DIR, INC_DIR, CFG_DIR, Help, AGENT_CONFIG_HJSON_TEMPLATE, CORUNNER_CONFIG_HJSON_TEMPLATE, CORUNNER_KMEMORY_JSON_TEMPLATE, COMPILE_CONFIG_HJSON_TEMPLATE, PSYMODULE_CONFIG_HJSON_TEMPLATE, FLASHLIKE
+import scripts.corunner
+from scripts.corunner import gen_corunner
+from scripts.kmem import gen_kmem, check_kmem
+from scripts.scriptutil import load_db, load_json, dump_json, write_template, psyko, print_psyko_stats, profile_step, print_profile_summary, write_profile, write_chrome_trace, psyko_object, psyko_cache_key, copy_atomic, write_atomic, file_digest, OBJ_CACHE_DIR, NO_OBJ_CACHE, gen_ea_index
 from operator import itemgetter
 
 def corunner_to_list(s):
@@ -56,12 +63,47 @@ def getopts(argv):
                         help=Help.MEM_CONF)
     parser.add_argument("--output", "-o", type=Path,
                         help=Help.OUTPUT)
+    parser.add_argument("--jobs", "-j", type=int, default=1,
+                        help=Help.JOBS)
+    parser.add_argument("--relink-from", type=Path,
+                        help=Help.RELINK_FROM)
+    parser.add_argument("--profile", type=Path,
+                        help=Help.PROFILE)
+    parser.add_argument("--chrome-trace", type=Path,
+                        help=Help.CHROME_TRACE)
     args = parser.parse_args(argv[1:])
     assert args.core not in cor_cores(args.corunner)
     if args.output is None:
         args.output = args.build_dir / "program.elf"
+    if args.relink_from is not None:
+        if args.mem_conf is None:
+            parser.error("--relink-from requires --mem-conf")
+        try:
+            base = load_json(args.relink_from / BUILD_INFO)
+        except OSError:
+            parser.error(f"{args.relink_from} is not a build directory")
+        if base["configuration"] != build_configuration(args):
+            parser.error(f"{args.relink_from} was built for another configuration")
     return args
 
+# Written in the build directory at the end of a build: what a relink
+# (--relink-from) needs to reuse from it.
+BUILD_INFO = "build.json"
+
+def build_configuration(args):
+    # What must be identical between a build and its relinks. The app
+    # configuration (e.g. the caches of the P2020) is written in the build
+    # directory before the build.
+    app_config = args.build_dir / "app.hjson"
+    return {
+        "product": args.product,
+        "task": args.task,
+        "core": args.core,
+        "corunner": sorted(args.corunner, key=itemgetter(0)),
+        "local_corunners": args.local_corunners,
+        "app": file_digest(app_config) if app_config.is_file() else None,
+    }
+
 def gen_agent_config(output_filename, name, core):
     write_template(output_filename, AGENT_CONFIG_HJSON_TEMPLATE, {
         "agent_name": name,
@@ -78,47 +120,73 @@ def gen_corunner_config(conf_filename, identifier, symbol, object_file, kmem_fil
         'symbol': symbol,
     })
 
-def gen_corunner_source(output_filename, symbol, read=dict()):
-    cmd = [sys.executable, TOP_DIR / "scripts" / "gen-corunner.py", symbol]
+def gen_corunner_source(output_filename, symbol, product, read=dict()):
+    """
+    Generates the assembly of a co-runner. It only depends on its parameters
+    (and on the generator), so it is cached in OBJ_CACHE_DIR: the object
+    cache then also provides the object assembled from it.
+    """
     if read:
-        cmd += ["--read"]
+        params = {"read": True}
         if 'nop' in read:
-          cmd += ["--nop", str(read['nop'])]
+          params["nop"] = int(read["nop"])
         if 'start' in read:
-          cmd += ["--startaddr", str(read['start'])]
+          params["startaddr"] = str(read['start'])
         if 'size' in read:
-          cmd += ["--tablesize", str(read['size'])]
+          params["tablesize"] = int(read["size"])
         if 'stride' in read:
-          cmd += ["--stride", str(read['stride'])]
+          params["stride"] = int(read["stride"])
     else:
-        cmd += ["--jump", "2048"]
-    with subprocess.Popen(cmd, stdout=subprocess.PIPE, universal_newlines=True) as proc:
+        params = {"jumps": 2048}
+    key = json.dumps([product, symbol, sorted(params.items()),
+                      file_digest(scripts.corunner.__file__)])
+    cache_file = OBJ_CACHE_DIR / 'corunners' / (hashlib.sha256(key.encode()).hexdigest() + '.asm')
+    with profile_step("corunner", symbol) as step:
+        if not NO_OBJ_CACHE and cache_file.is_file():
+            try:
+                copyfile(cache_file, output_filename)
+                step["cached"] = True
+                return
+            except OSError as e:
+                print(f"Cannot read {cache_file}: {e}", file=sys.stderr)
         with open(output_filename, "w") as fileh:
-            fileh.write(proc.stdout.read())
-
-def gen_kmem_final(default, config, memreport, kdbv, tasks, corunners=list()):
-    config_json = load_json(config)
-    cmd = [sys.executable, TOP_DIR / 'scripts' / 'gen-kmem.py', '--config', config]
-    del_list = []
-    config_json['memreport'] = str(memreport)
-    config_json['default_kmemory'] = str(default)
-    for el in config_json['elements']:
+            gen_corunner(fileh, symbol, **params)
+        if not NO_OBJ_CACHE:
+            copy_atomic(output_filename, cache_file)
+
+# When set, placements that check_kmem() finds invalid are linked anyway
+NO_KMEM_CHECK = bool(environ.get('NO_KMEM_CHECK', ''))
+
+def gen_kmem_final(default, config, memreport, tasks, corunners=list(), out=None):
+    """
+    Generates the final memory placement of the tasks and co-runners from the
+    default kmemory, as described by the mem-place config. memreport is the
+    parsed memory report of the first link. The default kmemory is
+    overwritten unless out is given.
+    The placement is checked before it is written: the build fails if it
+    brings sections that overlap, or that are out of their regions.
+    """
+    out = default if out is None else out
+    config = load_json(config)
+    elements = []
+    for el in config['elements']:
         if el['type'] == 'corunner':
             if corunners:
-                el['names'] = corunners
-            else:
-                del_list.append(el)
+                elements.append(dict(el, names=corunners))
         elif el['type'] == 'task':
-            el['names'] = tasks
-        else:
-            del_list.append(el)
-    for el in del_list:
-        config_json['elements'].remove(el)
-
-
-    dump_json(config_json, config)
-
-    ret = subprocess.check_call(cmd)
+            elements.append(dict(el, names=tasks))
+    config['elements'] = elements
+
+    default = load_json(default)
+    with profile_step("gen-kmem", Path(out).name):
+        kmem = gen_kmem(config, memreport, default)
+    if not NO_KMEM_CHECK:
+        with profile_step("check-kmem", Path(out).name):
+            conflicts = check_kmem(kmem, memreport, default)
+        if conflicts:
+            sys.exit("\n".join([f"*** Invalid memory placement for {out}:",
+                                *(conflict.message for conflict in conflicts)]))
+    dump_json(kmem, f=out)
 
 def get_sources(task_name):
     c_sources = [
@@ -140,8 +208,43 @@ def get_sources(task_name):
 
 
 
+def report_profile(args):
+    print_psyko_stats()
+    if args.profile is not None or args.chrome_trace is not None:
+        print_profile_summary()
+    if args.profile is not None:
+        write_profile(args.profile)
+    if args.chrome_trace is not None:
+        write_chrome_trace(args.chrome_trace)
+
+def relink(args, psykonf):
+    """
+    Only generates the memory placement and links the executable, with the
+    partition and the first memory report of a previous build.
+    """
+    base = load_json(args.relink_from / BUILD_INFO)
+    args.build_dir.mkdir(parents=True, exist_ok=True)
+    final_kmem = args.build_dir / "kmemconf_final.json"
+    gen_kmem_final(base["kmemconf"], args.mem_conf,
+                   load_db(args.kdbv, base["memreport"]),
+                   base["tasks"], base["corunners"], final_kmem)
+    if args.output.is_file():
+        args.output.unlink()
+    psyko(psykonf, "app", "-a", args.build_dir / "program.app", "-b", args.output,
+          '--gendir', args.build_dir / "gen" / "app", base["parto"],
+          *base["app_configs"], final_kmem, "--overwrite-memory-configuration")
+    assert args.output.is_file(), "final app compilation not successfull"
+    copyfile(args.relink_from / 'ea_index.json', args.build_dir / 'ea_index.json')
+    # The relinked build may be the base of other relinks
+    dump_json(base, f=args.build_dir / BUILD_INFO)
+
 def main(argv):
     args = getopts(argv)
+    psykonf = {'product': args.product, 'rtk_dir': args.rtk_dir, 'psyko': args.psyko, 'cwd': TOP_DIR}
+    if args.relink_from is not None:
+        relink(args, psykonf)
+        report_profile(args)
+        return
 
     used_cores = cor_cores(args.corunner) + [args.core]
     args.corunner.sort(key=itemgetter(0))
@@ -174,11 +277,11 @@ def main(argv):
         co_file = args.build_dir / f"corunner_{corunner}"
         if use_read:
             read_args['start'] = cor_start
-            read_args['size'] = int(env.get(f"CORUNNER_READ_SIZE_{corunner}", "0x2000"), 16)
+            read_args['size'] = int(environ.get(f"CORUNNER_READ_SIZE_{corunner}", "0x2000"), 16)
         symbol = f"co_runner_read{corunner}" if read_args else f"co_runner_flash{corunner}"
         co_file = co_file.with_suffix('.asm')
         sources["asm"].append(co_file)
-        gen_corunner_source(co_file, symbol, read_args)
+        gen_corunner_source(co_file, symbol, args.product, read_args)
 
         app_configs.append(co_config)
         mem_configs.append(co_kmem)
@@ -199,21 +302,23 @@ def main(argv):
     # The functions below are just helpers to call the PsyC compiler psyko,
     # with a convenient access to global variables such as the path to the
     # compiler and the path to the RTK.
-    psykonf = {'product': args.product, 'rtk_dir': args.rtk_dir, 'psyko': args.psyko, 'cwd': TOP_DIR}
+    # Any of the headers may be included by the sources: objects are reused
+    # from the cache only if none of them changed.
+    headers = sorted([*INC_DIR.iterdir(), *STUBS_DIR.glob("*.h")])
     def psyko_cc(c_source):
         generated_object = object_of(c_source)
-        psyko(psykonf, "cc", c_source, compile_config, "-o", generated_object)
-        return generated_object
+        key = psyko_object(psykonf, "cc", c_source, compile_config, generated_object, headers)
+        return generated_object, key
 
     def psyko_as(asm_source):
         generated_object = object_of(asm_source)
-        psyko(psykonf, "as", asm_source, compile_config, "-o", generated_object)
-        return generated_object
+        key = psyko_object(psykonf, "as", asm_source, compile_config, generated_object)
+        return generated_object, key
 
     def psyko_module(psy_source):
         generated_object = object_of(psy_source, ".psyo")
-        psyko(psykonf, "module", psy_source, psymodule_config, "-o", generated_object)
-        return generated_object
+        key = psyko_object(psykonf, "module", psy_source, psymodule_config, generated_object, headers)
+        return generated_object, key
 
     def psyko_partition(name, objects, configs):
         generated_object = args.build_dir / (name + ".parto")
@@ -270,28 +375,89 @@ def main(argv):
     #==========================================================================
     # Compile all the C, ASM and PsyC sources.
     # ASM sources are only present when co-runners are enabled.
-    parto_objects = []
-    for c_source in sources["c"]:
-        parto_objects.append(psyko_cc(c_source))
-    for asm_source in sources.get("asm", []):
-        parto_objects.append(psyko_as(asm_source))
-    for psy_source in sources["psy"]:
-        parto_objects.append(psyko_module(psy_source))
+    # They are all independent, so they are compiled concurrently (up to
+    # --jobs at a time); objects are kept in the order of the sources, along
+    # with their cache keys.
+    with ThreadPoolExecutor(max(1, args.jobs)) as pool:
+        compiled = [pool.submit(psyko_cc, c_source) for c_source in sources["c"]]
+        compiled += [pool.submit(psyko_as, asm_source) for asm_source in sources.get("asm", [])]
+        compiled += [pool.submit(psyko_module, psy_source) for psy_source in sources["psy"]]
+        parto_objects = [job.result()[0] for job in compiled]
+        object_keys = [job.result()[1] for job in compiled]
 
     #==========================================================================
     # Generate a single partition, and then executable to be able to get the size of the sections
     parto = psyko_partition("main", parto_objects, part_configs)
-    mem_configs = [psyko_memconf('app', [parto], app_configs, mem_configs)]
-    mem_configs.append("--overwrite-memory-configuration")
-    gendir = psyko_app([parto], app_configs+mem_configs)
-    assert args.output.is_file(), "first app compilation not successfull"
-    # Finally generate the final memory configs and the executable
+    # The first link only provides the size of the sections to the memory
+    # placement. It depends on the objects and on the configurations only,
+    # so its outputs are cached: builds of the same task with the same
+    # co-runners, that only differ by their placement, go straight to the
+    # final link. The parsed memory report is cached as well, so that the
+    # placement does not need kdbv on a cache hit.
+    # The objects are identified by their cache keys: their content refers
+    # to the build directory that compiled them first, which may not be
+    # this one when they come from the cache.
+    memreport = args.build_dir / 'memreport_first.ks'
+    memreport_db = None
+    first_link = OBJ_CACHE_DIR / 'links' / psyko_cache_key(psykonf, 'app',
+        [*part_configs, *app_configs, *mem_configs], args.build_dir, object_keys)
+    cached = args.mem_conf and not NO_OBJ_CACHE and \
+        (first_link / 'kmemconf.json').is_file() and \
+        (first_link / 'memreport.ks').is_file()
+    if cached:
+        print(f"[CACHED] first link of '{parto}'")
+        mem_configs = [args.build_dir / ('kmemconf_app.json')]
+        with profile_step("psyko app", args.output.name, cached=True):
+            copyfile(first_link / 'kmemconf.json', mem_configs[0])
+            copyfile(first_link / 'memreport.ks', memreport)
+            if (first_link / 'memreport.json').is_file():
+                memreport_db = load_json(first_link / 'memreport.json')
+        mem_configs.append("--overwrite-memory-configuration")
+        gendir = args.build_dir / "gen" / "app"
+    else:
+        mem_configs = [psyko_memconf('app', [parto], app_configs, mem_configs)]
+        mem_configs.append("--overwrite-memory-configuration")
+        gendir = psyko_app([parto], app_configs+mem_configs)
+        assert args.output.is_file(), "first app compilation not successfull"
+        # Keep the memory report of this first link: the final link overwrites it
+        copyfile(gendir / 'applink' / 'memreport_out.ks', memreport)
+        if not NO_OBJ_CACHE:
+            copy_atomic(memreport, first_link / 'memreport.ks')
+            copy_atomic(mem_configs[0], first_link / 'kmemconf.json')
+    # Finally generate the final memory configs and the executable. The
+    # default memory configuration is left untouched, for relinks.
     if args.mem_conf:
-      args.output.unlink()
-      gen_kmem_final(mem_configs[0], args.mem_conf,
-          gendir / 'applink' / 'memreport_out.ks', args.kdbv, tasks, corunners)
-      psyko_app([parto], app_configs+mem_configs)
+      if args.output.is_file():
+        args.output.unlink()
+      if memreport_db is None:
+        memreport_db = load_db(args.kdbv, memreport)
+        if not NO_OBJ_CACHE:
+          write_atomic(first_link / 'memreport.json',
+                       json.dumps(memreport_db, separators=(',', ':')))
+      final_kmem = args.build_dir / 'kmemconf_final.json'
+      gen_kmem_final(mem_configs[0], args.mem_conf, memreport_db,
+          tasks, corunners, final_kmem)
+      psyko_app([parto], app_configs+[final_kmem]+mem_configs[1:])
       assert args.output.is_file(), "final app compilation not successfull"
 
+    #==========================================================================
+    # Emit the index of the EAs of the task, so that the measures can be
+    # analyzed without kdbv nor the databases of the build directory.
+    gen_ea_index(args.kdbv,
+                 gendir / 'partos' / '0' / 'dbs' / f'task_{args.task}_kcfg.ks',
+                 gendir / 'config' / 'kapp.ks', args.task,
+                 args.build_dir / 'ea_index.json')
+
+    dump_json({
+        "configuration": build_configuration(args),
+        "parto": str(parto.resolve()),
+        "app_configs": [str(config.resolve()) for config in app_configs],
+        "kmemconf": str(mem_configs[0].resolve()),
+        "memreport": str(memreport.resolve()),
+        "tasks": tasks,
+        "corunners": corunners,
+    }, f=args.build_dir / BUILD_INFO)
+    report_profile(args)
+
 if __name__ == "__main__":
     main(sys.argv)
@@ -0,0 +1,304 @@
+#! /usr/bin/env python3
+#
+# This script runs a whole test campaign: it builds every configuration of a
+# test matrix (see exemples/campaign.json) with build.py, and runs each of
+# them on the target with the Trace32 hook, to collect its measures.
+#
+# Builds are independent, so they run concurrently (--jobs), each one in its
+# own build directory. The hook drives the hardware target, so it is only run
+# by a single consumer, one configuration at a time and in the order of the
+# matrix: the target measures a configuration while the next ones are built.
+#
+# A manifest records, for each configuration, the program that was built and
+# the trace it produced, with their checksums. When a campaign is run again
+# (e.g. after it was interrupted), configurations whose trace is still valid
+# are skipped, and programs are only rebuilt if their inputs changed.
+
+import argparse
+from pathlib import Path
+import subprocess
+import sys
+from shutil import rmtree
+from os import environ
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from datetime import datetime
+from shutil import which
+import hashlib
+import json
+from scripts.templates import P2020, MPC5777M, TOP_DIR, CFG_DIR
+from scripts.scriptutil import load_json, file_identity, file_digest, write_atomic
+
+# Cache flags of the P2020 app configurations, as accepted in "caches"
+CACHE_FLAGS = {
+    "i0": "ICACHE0",
+    "d0": "DCACHE0",
+    "i1": "ICACHE1",
+    "d1": "DCACHE1",
+}
+
+# Keys of a configuration of the matrix, and their default values
+DEFAULTS = {
+    "task": None,
+    "core": None,
+    "corunners": [],
+    "local_corunners": False,
+    "caches": [],
+    "placement": None,
+    "env": {},
+    "out": None,
+}
+
+# Files of the repository a build depends on, besides the matrix: build.py
+# and the modules it imports, not the scripts that analyze the traces
+INPUTS = ["build.py", "config", "include", "psy", "src",
+          "scripts/templates.py", "scripts/scriptutil.py",
+          "scripts/corunner.py", "scripts/kmem.py"]
+
+MANIFEST_VERSION = 1
+
+OUTPUT_LOCK = Lock()
+MANIFEST_LOCK = Lock()
+
+def getopts(argv):
+    parser = argparse.ArgumentParser(description='Corunners campaign runner')
+    parser.add_argument("matrix", type=Path,
+                        help="JSON file describing the configurations to build and run")
+    parser.add_argument("--psyko", "-P", type=Path, required=True)
+    parser.add_argument("--kdbv", type=Path, required=True)
+    parser.add_argument("--rtk-dir", "-K", type=Path, required=True)
+    parser.add_argument("--product", "-p", type=str, required=True,
+                        choices=[P2020,MPC5777M])
+    parser.add_argument("--hook", type=Path,
+                        help="Executable that runs a program on the target and dumps its measures")
+    parser.add_argument("--build-dir", type=Path, default=TOP_DIR / "build",
+                        help="Directory in which the build directories of the configurations are created")
+    parser.add_argument("--traces-dir", type=Path, default=TOP_DIR / "traces",
+                        help="Directory in which the measures are dumped")
+    parser.add_argument("--jobs", "-j", type=int, default=1,
+                        help="Number of configurations built concurrently")
+    parser.add_argument("--build-jobs", type=int, default=1,
+                        help="Number of sources compiled concurrently by each build")
+    parser.add_argument("--build-only", action='store_true',
+                        help="Only build the configurations, do not run them")
+    parser.add_argument("--manifest", type=Path,
+                        help="Manifest of the configurations already built and run (default: <traces-dir>/manifest.json)")
+    parser.add_argument("--force", action='store_true',
+                        help="Build and run all the configurations, even those recorded in the manifest")
+    args = parser.parse_args(argv[1:])
+    if args.manifest is None:
+        args.manifest = args.traces_dir / "manifest.json"
+    if args.hook is None and not args.build_only:
+        parser.error("--hook is required, unless --build-only is set")
+    return args
+
+def load_matrix(path):
+    """
+    Returns the list of configurations of a matrix. The matrix is a JSON
+    object whose "configurations" is a list of objects with the keys of
+    DEFAULTS; any other key of the matrix is a default value for all the
+    configurations.
+    """
+    matrix = load_json(path)
+    configurations = []
+    for entry in matrix.pop("configurations"):
+        config = dict(DEFAULTS)
+        for key, val in [*matrix.items(), *entry.items()]:
+            if key not in DEFAULTS:
+                sys.exit(f"{path}: unknown key '{key}'")
+            config[key] = val
+        for key in ("task", "core", "out"):
+            if config[key] is None:
+                sys.exit(f"{path}: '{key}' is required (configuration {len(configurations)})")
+        configurations.append(config)
+    outs = [config["out"] for config in configurations]
+    if len(set(outs)) != len(outs):
+        sys.exit(f"{path}: several configurations have the same 'out'")
+    return configurations
+
+def gen_app_config(output_filename, product, caches):
+    # Same as activate_caches() in the run script of the P2020
+    context = {flag: "false" for flag in CACHE_FLAGS.values()}
+    for cache in caches:
+        context[CACHE_FLAGS[cache]] = "true"
+    with open(CFG_DIR / f"app.{product}.hjson") as stream:
+        template = stream.read()
+    for flag, val in context.items():
+        template = template.replace(f"@{flag}@", val)
+    with open(output_filename, "w") as stream:
+        stream.write(template)
+
+def place(placement):
+    # {"address": 42} => '"address": 42', for mem-place.json
+    return ', '.join(f"{json.dumps(key)}: {json.dumps(val)}"
+                     for key, val in placement.items())
+
+def gen_mem_place(output_filename, kdbv, placement):
+    # Same as kmem_gen_config_setup() in the run script of the P2020
+    with open(CFG_DIR / "mem-place.json") as stream:
+        text = stream.read()
+    text = text.replace("@CORUNNER_PLACE@", place(placement.get("corunner", {})))
+    text = text.replace("@TASK_PLACE@", place(placement.get("task", {})))
+    text = text.replace("@KDBV@", str(kdbv))
+    with open(output_filename, "w") as stream:
+        stream.write(text)
+
+def inputs_digest(args):
+    """
+    Digest of all the inputs of the builds that do not appear in the
+    matrix: the sources of the repository, the product and the tools.
+    """
+    digest = hashlib.sha256()
+    for item in (args.product, file_identity(which(args.psyko) or args.psyko),
+                 file_identity(args.rtk_dir), file_identity(which(args.kdbv) or args.kdbv)):
+        digest.update(f"{item}\0".encode())
+    for top in INPUTS:
+        top = TOP_DIR / top
+        paths = [top] if top.is_file() else sorted(top.rglob("*"))
+        for path in paths:
+            if path.is_file() and "__pycache__" not in path.parts:
+                digest.update(f"{path.relative_to(TOP_DIR)}\0".encode())
+                digest.update(path.read_bytes())
+    return digest.hexdigest()
+
+def config_digest(inputs, config):
+    text = inputs + json.dumps(config, sort_keys=True)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+def load_manifest(path):
+    # The manifest maps configuration digests to:
+    #  - out: name of the configuration
+    #  - artifact: checksum of the program built for it
+    #  - trace, checksum, timestamp: the trace collected by the hook
+    try:
+        manifest = load_json(path)
+    except (OSError, ValueError):
+        return dict()
+    if manifest.get("version") != MANIFEST_VERSION:
+        return dict()
+    return manifest["configurations"]
+
+def update_manifest(path, manifest, key, **entry):
+    with MANIFEST_LOCK:
+        manifest.setdefault(key, dict()).update(entry)
+        write_atomic(path, json.dumps({"version": MANIFEST_VERSION,
+                                       "configurations": manifest}, indent=2))
+
+def trace_is_valid(entry):
+    trace = entry.get("trace")
+    return trace is not None and Path(trace).is_file() and \
+        file_digest(trace) == entry.get("checksum")
+
+def build_dir_of(args, config):
+    return args.build_dir / config["out"]
+
+def trace_of(args, config):
+    return args.traces_dir / f"{config['out']}.bin"
+
+def build(args, config):
+    """
+    Builds a configuration of the matrix in its own build directory, with
+    build.py run in a separate process. Its output is printed at once when
+    the build is over, so that concurrent builds do not mix their outputs.
+    """
+    build_dir = build_dir_of(args, config)
+    if build_dir.exists():
+        rmtree(build_dir)
+    build_dir.mkdir(parents=True)
+
+    cmd = [sys.executable, TOP_DIR / "build.py",
+           "--psyko", args.psyko,
+           "--kdbv", args.kdbv,
+           "--rtk-dir", args.rtk_dir,
+           "--task", config["task"],
+           "--core", str(config["core"]),
+           "--build-dir", build_dir,
+           "--product", args.product,
+           "--jobs", str(args.build_jobs)]
+    for corunner in config["corunners"]:
+        cmd += [f"--corunner={','.join(map(str, corunner))}"]
+    if config["local_corunners"]:
+        cmd += ["--local-corunners"]
+    if config["placement"] is not None:
+        mem_place = build_dir / "mem-place.json"
+        gen_mem_place(mem_place, args.kdbv, config["placement"])
+        cmd += ["--mem-conf", mem_place]
+    gen_app_config(build_dir / "app.hjson", args.product, config["caches"])
+
+    env = dict(environ)
+    env.update({key: str(val) for key, val in config["env"].items()})
+    proc = subprocess.run(cmd, env=env, cwd=TOP_DIR, universal_newlines=True,
+                          stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    with OUTPUT_LOCK:
+        print("#" * 68)
+        print(f"# Build of {config['out']} ({build_dir})")
+        print(proc.stdout, flush=True)
+    if proc.returncode != 0:
+        raise RuntimeError(f"failed to build {config['out']} (see {build_dir})")
+    return build_dir / "program.elf"
+
+def run_hook(args, config, elf):
+    env = dict(environ)
+    env.update({key: str(val) for key, val in config["env"].items()})
+    trace = trace_of(args, config)
+    trace.parent.mkdir(parents=True, exist_ok=True)
+    cmd = [args.hook, elf, str(config["core"]), trace]
+    if args.product == P2020:
+        cmd += [args.traces_dir / "times.log"]
+    with OUTPUT_LOCK:
+        print(f"[RUN] {' '.join(map(str, cmd))}", flush=True)
+    subprocess.check_call(cmd, env=env, cwd=TOP_DIR)
+    return trace
+
+def build_once(args, config, manifest, key):
+    """
+    Same as build(), unless the build directory already holds the program
+    recorded in the manifest for the configuration.
+    """
+    elf = build_dir_of(args, config) / "program.elf"
+    artifact = manifest.get(key, dict()).get("artifact")
+    if artifact is not None and elf.is_file() and file_digest(elf) == artifact:
+        with OUTPUT_LOCK:
+            print(f"# {config['out']} is up to date", flush=True)
+        return elf
+    elf = build(args, config)
+    update_manifest(args.manifest, manifest, key, out=config["out"],
+                    artifact=file_digest(elf))
+    return elf
+
+def main(argv):
+    args = getopts(argv)
+    configurations = load_matrix(args.matrix)
+    manifest = dict() if args.force else load_manifest(args.manifest)
+    inputs = inputs_digest(args)
+
+    todo = []
+    for config in configurations:
+        key = config_digest(inputs, config)
+        if not args.force and trace_is_valid(manifest.get(key, dict())):
+            print(f"# {config['out']} was already run, skipped")
+            continue
+        todo.append((config, key))
+
+    pool = ThreadPoolExecutor(max(1, args.jobs))
+    builds = [pool.submit(build_once, args, config, manifest, key)
+              for config, key in todo]
+    try:
+        # The single consumer of the builds: configurations are run on the
+        # target one at a time, in the order of the matrix.
+        for (config, key), job in zip(todo, builds):
+            elf = job.result()
+            if not args.build_only:
+                trace = run_hook(args, config, elf)
+                update_manifest(args.manifest, manifest, key, trace=str(trace),
+                                checksum=file_digest(trace),
+                                timestamp=datetime.now().isoformat(timespec='seconds'))
+    except (RuntimeError, subprocess.CalledProcessError) as e:
+        for job in builds:
+            job.cancel()
+        sys.exit(f"*** {e}")
+    finally:
+        pool.shutdown()
+
+if __name__ == "__main__":
+    main(sys.argv)
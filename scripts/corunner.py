@@ -0,0 +1,90 @@
+# This file is imported by build.py and gen-corunner.py.
+#
+# It generates the code of two types of co-runners:
+# 1) JUMP co-runners, as a finite sequence of unconditional branches, that eventually loops:
+#
+#   label_0: branch label_1
+#   label_1: branch label_2
+#   label_2: branch label_3
+#   ...
+#   label_n: branch label_0
+#
+# 2) READ co-runners, as a finite sequence of read and write in memory, that
+# eventualy loops:
+#
+#   loop:
+#   read read_register, read_addr
+#   write read_register, write_addr
+#   read read_register, (read_addr << 1*stride)
+#   write read_register, (write_addr << 1*stride)
+#   ...
+#   read read_register, (read_addr << n*stride)
+#   write read_register, (write_addr << n*stride)
+#   branch loop
+#
+# nop intructions can be added between each sequence.
+#
+# The code is written by batches of lines: read co-runners are made of tens
+# of thousands of lines.
+
+BATCH = 4096
+
+def gen_header(stream, symbol):
+    stream.write(f"""
+# This is a generated file")
+
+  .global {symbol}
+  .type {symbol}, @function
+
+{symbol}:
+  \n""")
+
+def gen_footer(stream, symbol, suffix=""):
+    stream.write(f"\tb {symbol}{suffix}\n\n")
+    stream.write(f".size {symbol}, .- {symbol}\n")
+
+def read_cor(stream, symbol, startaddr, tablesize, stride, nop):
+    # Generate preamble
+    stream.write("\tlis r3, global_data@ha\n"
+                 "\taddi	r3,r3,global_data@l\n"
+                 f"\tlis r0, {startaddr}@ha\n"
+                 f"\taddi	r0,r0,{startaddr}@l\n"
+                 f"{symbol}_loop:\n")
+
+    nops = "\tnop\n" * nop
+    for batch in range(0, tablesize, BATCH):
+        stream.write(''.join(f"\tlwz r4,{i*stride}(r0)\n\tstw r4,0(r3)\n{nops}"
+                             for i in range(batch, min(batch + BATCH, tablesize))))
+
+    gen_footer(stream, symbol, suffix="_loop")
+    stream.write(f"""
+\t.bss
+\t.type global_data, @object
+\t.size global_data,{stride}
+\t.align 2
+global_data:
+\t.space {stride}
+\n""")
+
+def jump_cor(stream, symbol, jumps):
+    for batch in range(0, jumps - 1, BATCH):
+        stream.write(''.join(f"\tb next{i}\nnext{i}:\n"
+                             for i in range(batch, min(batch + BATCH, jumps - 1))))
+    gen_footer(stream, symbol)
+
+def gen_corunner(stream, symbol, read=False, jumps=1, startaddr="0x1380000",
+                 tablesize=0x10000, stride=4, nop=0):
+    """
+    Writes the assembly of a co-runner to stream: a read co-runner if read
+    is set, a jump co-runner otherwise.
+    """
+    assert jumps >= 1, "--jumps must be >= 1"
+    assert stride >= 0, "--stride must be >= 0"
+    assert tablesize >= 1, "--tablesize must be >= 1"
+    assert nop >= 0, "--nop must be >= 0"
+
+    gen_header(stream, symbol)
+    if read:
+        read_cor(stream, symbol, startaddr, tablesize, stride, nop)
+    else:
+        jump_cor(stream, symbol, jumps)
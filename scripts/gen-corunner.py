@@ -34,13 +34,13 @@
 #   --tablesize 1024 --stride 4 --nop 0 > code.asm
 #
 # Both enable to generate code of a fixed size, without having to manually
-# perform these changes.
+# perform these changes. The code is generated by corunner.py, that build.py
+# uses directly.
 
 
 import argparse
 import sys
-
-LOOP_SIZE = 1024
+from corunner import gen_corunner
 
 parser = argparse.ArgumentParser()
 parser.add_argument('symbol')
@@ -51,61 +51,6 @@ parser.add_argument('--tablesize', type=int, default=0x10000)
 parser.add_argument('--stride', type=int, default=4)
 parser.add_argument('--nop', type=int, default=0)
 args = parser.parse_args(sys.argv[1:])
-assert args.jumps >= 1, "--jumps must be >= 1"
-assert args.stride >= 0, "--stride must be >= 0"
-assert args.tablesize >= 1, "--tablesize must be >= 1"
-assert args.nop >= 0, "--nop must be >= 0"
-
-def gen_header():
-  print(f"""
-# This is a generated file")
-
-  .global {args.symbol}
-  .type {args.symbol}, @function
-
-{args.symbol}:
-  """)
-
-def gen_footer(suffix=""):
-  print(f"\tb {args.symbol}{suffix}\n")
-  print(f".size {args.symbol}, .- {args.symbol}")
-
-def read_cor():
-  # Generate preamble
-  print("\tlis r3, global_data@ha")
-  print("\taddi	r3,r3,global_data@l")
-  #print("\tdiab.li r0, 1337")
-  print(f"\tlis r0, {args.startaddr}@ha")
-  print(f"\taddi	r0,r0,{args.startaddr}@l")
-  print(f"{args.symbol}_loop:")
-
-  for i in range(0, args.tablesize):
-    print(f"\tlwz r4,{i*args.stride}(r0)")
-    print(f"\tstw r4,0(r3)")
-    for j in range(0, args.nop):
-      print("\tnop")
-
-  gen_footer(suffix="_loop")
-  print(f"""
-\t.bss
-\t.type global_data, @object
-\t.size global_data,{args.stride}
-\t.align 2
-global_data:
-\t.space {args.stride}
-""")
-
-def jump_cor():
-  for i in range(args.jumps - 1):
-    print(f"\tb next{i}\nnext{i}:")
-  gen_footer()
-
-gen_header()
-
-if args.read:
-  read_cor()
-else:
-  jump_cor()
-
-
 
+gen_corunner(sys.stdout, args.symbol, args.read, args.jumps, args.startaddr,
+             args.tablesize, args.stride, args.nop)
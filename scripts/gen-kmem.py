@@ -9,22 +9,73 @@
 #
 # Notes:
 #   * The default kmemory will be overwritten. To avoid that, add --out_kmem to specify an other output file.
+#   * The generated kmemory is checked (overlapping sections, sections out of their region, misaligned sections): the script fails without writing it if it has conflicts that the default kmemory has not.
 #   * An exemple template for the json config file is available at /exemples/mem-place.json. In each sections, at least of address or region must be present. The names of the elements must be the task names for agents and the identifiers in the default kmem for the corunners.
 #  * Except the config file arguments, all options can be put in the config json. options specified as arguments will overwrite options specified in the config.
 #
 # Both the data and the text can be set separatly.
+#
+# Sweep mode:
+#   python3 gen-kmem.py --config {json config file} --task-addresses {addresses} --corunner-addresses {addresses} --out-dir {directory}
+#
+# generates the kmemory of every pair of task and co-runner addresses at once, in --out-dir, with sweep.json as index.
+# Invalid placements are not written, and their errors are recorded in sweep.json.
+# Addresses are comma-separated, and may be start:stop:step ranges (the step may be fractional, as in the run scripts).
+# The addresses replace the placement of the task or co-runner elements of the config.
 
 
 import argparse
 import sys
-import json
 from scriptutil import load_db, load_json, dump_json
-from copy import deepcopy
+from kmem import gen_kmem, check_kmem, conflict_keys, Sweep
 from pathlib import Path
+from itertools import product
+
+def number(text):
+    try:
+        return int(text, 0)
+    except ValueError:
+        return float(text)
 
-def del_all_list(l, rem):
-    for el in l:
-        rem.remove(el)
+def addresses(text):
+    result = []
+    for item in text.split(','):
+        if ':' in item:
+            start, stop, step = map(number, item.split(':'))
+            if step <= 0:
+                raise ValueError(item)
+            i = 0
+            while start + i*step < stop:
+                result.append(int(start + i*step + 0.5))
+                i += 1
+        else:
+            result.append(int(number(item) + 0.5))
+    return result
+
+def sweep(args, config, memreport, default):
+    places = Sweep(config, memreport, default)
+    known = conflict_keys(check_kmem(default, memreport))
+    args.out_dir.mkdir(parents=True, exist_ok=True)
+    index = []
+    for task, corunner in product(args.task_addresses or [None],
+                                  args.corunner_addresses or [None]):
+        entry = {"task": task, "corunner": corunner}
+        errors = places.check((task, corunner))
+        if not errors:
+            kmem = places.kmemory((task, corunner))
+            errors = [conflict.message for conflict in check_kmem(kmem, memreport)
+                      if (conflict.kind, conflict.names) not in known]
+        if errors:
+            for error in errors:
+                print(f"T={task} C={corunner}: {error}", file=sys.stderr)
+            entry["errors"] = errors
+        else:
+            name = "kmem" + (f"-T{task:#x}" if task is not None else "") + \
+                (f"-C{corunner:#x}" if corunner is not None else "") + ".json"
+            dump_json(kmem, args.out_dir / name)
+            entry["kmemory"] = name
+        index.append(entry)
+    dump_json(index, args.out_dir / "sweep.json")
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--config', nargs='?', type=argparse.FileType('r'), default='-')
@@ -32,7 +83,12 @@ parser.add_argument('--memreport', type=Path)
 parser.add_argument('--default_kmemory', type=Path)
 parser.add_argument('--out_kmemory', type=Path)
 parser.add_argument("--kdbv", type=Path)
+parser.add_argument('--task-addresses', type=addresses)
+parser.add_argument('--corunner-addresses', type=addresses)
+parser.add_argument('--out-dir', type=Path)
 args = parser.parse_args(sys.argv[1:])
+if (args.task_addresses or args.corunner_addresses) and not args.out_dir:
+    parser.error("--out-dir is required with --task-addresses or --corunner-addresses")
 
 config = load_json(args.config)
 
@@ -44,165 +100,20 @@ try:
     if not args.kdbv:
         args.kdbv = config['kdbv']
 except KeyError as e:
-    print(f"{e.args[0]} must be pased either in the config json or in program parameters!", file=stderr)
+    sys.exit(f"{e.args[0]} must be pased either in the config json or in program parameters!")
 
 if not args.out_kmemory:
     args.out_kmemory = config.get('out_kmemory', args.default_kmemory)
 
-memreport = load_db(args.kdbv, args.memreport)
-kmem = load_json(args.default_kmemory)
-
-sec_sat = dict()
-for sec in memreport['sections']:
-    if 'id_name' in sec:
-        id_name = sec['id_name']
-    else:
-        id_name = ''
-    sec_sat[sec['name']] = [sec['size'], sec['address'], sec['type'], id_name]
-    del sec
-
-for el in config['elements']:
-    assert el['type'] in ['corunner', 'task']
-    secs = []
-    if el['type'] == 'corunner':
-        for reg in kmem['kmemory']['regions']:
-            if 'domains' in reg:
-                del_dom = []
-                for dom in reg['domains']:
-                    if 'identifier' in dom and dom['identifier'] in el['names']:
-                        d = set()
-                        for sec in dom['output_sections']:
-                            d.add(sec['name'])
-                        secs.append([d, deepcopy(dom), reg['name']])
-                        del_dom.append(dom)
-                del_all_list(del_dom, reg['domains'])
-    else:
-        sec_sat2 = deepcopy(sec_sat)
-        for sec in sec_sat.keys():
-            if sec_sat[sec][3] not in el['names']:
-                del sec_sat2[sec]
-
-        for reg in kmem['kmemory']['regions']:
-            if 'domains' in reg:
-                del_dom = []
-                for dom in reg['domains']:
-                    d = set()
-                    for sec in dom['output_sections']:
-                        if sec['name'] in sec_sat2:
-                            d.add(sec['name'])
-                    if d:
-                        secs.append([d, deepcopy(dom), reg['name']])
-                        del_dom.append(dom)
-                del_all_list(del_dom, reg['domains'])
-    if not secs:
-        continue
-
-    for sec in el['sections']:
-        assert set(sec.keys()).intersection({'region','address'}), \
-            "A least one of 'region', 'address' must be present in placement configuration"
-        d = set()
-        comp = False
-        secs_2 = deepcopy(secs)
-        del_s = []
-        for s in secs_2:
-            for n in s[0]:
-                if sec_sat[n][2] in sec['names']:
-                    d.add(n)
-#                else:
-#                    for os in s[1]['output_sections']:
-#                        if os['name'] == n:
-#                            del os
-            inter = d.intersection(s[0])
-            if not inter:
-                del_s.append(s)
-        del_all_list(del_s, secs_2)
-
-        def find_reg_name():
-            for reg in kmem['kmemory']['regions']:
-                addr = reg['physical_address']
-                if addr <= sec['address'] < addr+reg['size']:
-                    return reg['name']
-        reg_name = sec['region'] if 'region' in sec else find_reg_name()
-        for reg in kmem['kmemory']['regions']:
-            if reg['name'] == reg_name:
-                if 'domains' not in reg:
-                    reg['domains'] = []
-                if 'address' not in sec:
-                    if not reg['domains']:
-                        secs_2[0][1]['output_sections'][0]['physical_address'] = reg['physical_address']
-                    for s in secs_2:
-                        reg['domains'].append(s[1])
-                else:
-                    addr1 = reg['physical_address']
-                    addr2 = 0
-                    place_size = []
-                    for s in secs_2:
-                        dom_size=0
-                        for name in s[0]:
-                            dom_size += sec_sat[name][0]
-                        place_size.append(dom_size)
-                    dom_ind = 0
-                    reg2 = deepcopy(reg['domains'])
-                    placed = False
-                    dec = False
-                    def al(os, j):
-                        align=0
-                        if 'alignment' in os:
-                            align = os['alignment']**3
-                        elif j == 0:
-                            align = 4096
-                        if align and os['physical_address']%align:
-                            off = align-os['physical_address']%align
-                        else:
-                            off = 0
-                        os['physical_address'] += off
-                        return off
-                    for i in range(0, len(reg2)):
-                        l = 0
-                        if placed:
-                            l = len(secs_2)
-                        osi = reg['domains'][i+l]['output_sections']
-                        for j in range(0, len(reg2[i]['output_sections'])):
-                            os = osi[j]
-                            if not placed:
-                                addr2 = os['physical_address'] if 'physical_address' in os else sec_sat[os['name']][1]
-                                if addr1 < sec['address'] < addr2+sec_sat[os['name']][0]:
-                                    os0 = osi[0]
-                                    #os0['physical_address'] = sec_sat[os0['name']][1]
-                                    #al(os0, 0)
-                                    placed = True
-                                    off = 0
-                                    align = 0
-                                    for s in secs_2[::-1]:
-                                        s[1]['output_sections'][0]['physical_address'] = sec['address']+off
-                                        align_tmp = al(s[1]['output_sections'][0], 0)
-                                        reg['domains'].insert(i, s[1])
-                                        off += place_size[secs_2.index(s)] + align_tmp
-                                        align += align_tmp
-                                    if sec['address'] > addr2 or sum(place_size)+align >= addr2-sec['address']:
-                                        dec = True
-                                        os['physical_address'] = sec['address']+sum(place_size)+align
-                                        al(os, j)
-                                        place_size.append(align)
-                                    else:
-                                        break
-                            elif 'physical_address' in os:
-                                os['physical_address'] = os['physical_address']+sum(place_size)
-                                al(os, j)
-                        if placed and not dec:
-                            break
-                        addr1 = addr2
-                    if not placed:
-                        placed = True
-                        align = 0
-                        off = 0
-                        for s in secs_2:
-                            s[1]['output_sections'][0]['physical_address'] = sec['address'] + off
-                            align_tmp = al(s[1]['output_sections'][0], 0)
-                            if 'domains' not in reg:
-                                reg['domains'] = []
-                            reg['domains'].append(s[1])
-                            off += place_size[secs_2.index(s)] + align_tmp
-                            align += align_tmp
+if args.out_dir:
+    sweep(args, config, load_db(args.kdbv, args.memreport), load_json(args.default_kmemory))
+    sys.exit()
 
+memreport = load_db(args.kdbv, args.memreport)
+default = load_json(args.default_kmemory)
+kmem = gen_kmem(config, memreport, default)
+conflicts = check_kmem(kmem, memreport, default)
+if conflicts:
+    sys.exit("\n".join([f"*** Invalid memory placement for {args.out_kmemory}:",
+                        *(conflict.message for conflict in conflicts)]))
 dump_json(kmem, args.out_kmemory)
@@ -0,0 +1,465 @@
+# This file is imported by build.py and gen-kmem.py.
+#
+# It places the domains of the tasks and of the co-runners in a kmemory (the
+# memory configuration given to psyko), as described by the elements of a
+# placement configuration (see config/mem-place.json):
+#
+#  * the domains of an element are removed from their regions;
+#  * for each of its "sections", the domains that hold sections of these
+#    types are put back in the "region", or in the region of "address" at that
+#    address: the domains that follow are then moved after them.
+#
+# The regions are sorted by address, so that the region of an address is
+# found by bisection. The output sections of the domains of a region are
+# indexed the same way (DomainIndex), which gives the place of an address in
+# the region in O(log n), and the sections that follow it are relocated in a
+# single pass.
+#
+# check_kmem() validates a placement before the link, with a sweep of the
+# output sections sorted by address.
+
+from bisect import bisect_right
+from collections import namedtuple
+from copy import deepcopy
+
+# Output sections of the memreport
+Section = namedtuple("Section", ["size", "address", "type", "id_name"])
+
+ELEMENT_TYPES = ("corunner", "task")
+
+# Alignment of the first output section of a domain, when it has none
+DOMAIN_ALIGNMENT = 4096
+
+def section_table(memreport):
+    return {sec['name']: Section(sec['size'], sec['address'], sec['type'],
+                                 sec.get('id_name', ''))
+            for sec in memreport['sections']}
+
+def psyko_alignment(os):
+    """
+    Returns the alignment, in bytes, of the output section os once linked
+    (0 if it has none): its "alignment" is a power of two, as the operand of
+    the .align directive of the PowerPC assembler.
+    """
+    return 2**os['alignment'] if 'alignment' in os else 0
+
+def section_alignment(os, first):
+    # Where the placement puts os: at its alignment, or on a page if it is
+    # the first section of its domain and has none
+    alignment = psyko_alignment(os)
+    if not alignment and first:
+        return DOMAIN_ALIGNMENT
+    return alignment
+
+def align(os, first):
+    """
+    Moves the output section os up to its alignment, and returns the offset.
+    """
+    alignment = section_alignment(os, first)
+    off = -os['physical_address'] % alignment if alignment else 0
+    os['physical_address'] += off
+    return off
+
+class Layout:
+    """
+    Regions of a kmemory, sorted by physical address.
+    """
+    def __init__(self, kmem):
+        self.regions = kmem['kmemory']['regions']
+        self.by_name = dict()
+        for reg in self.regions:
+            self.by_name.setdefault(reg['name'], reg)
+        self.sorted = sorted(self.regions, key=lambda reg: reg['physical_address'])
+        self.starts = [reg['physical_address'] for reg in self.sorted]
+
+    def region(self, name):
+        return self.by_name.get(name)
+
+    def region_at(self, address):
+        i = bisect_right(self.starts, address) - 1
+        if i >= 0 and address < self.starts[i] + self.sorted[i]['size']:
+            return self.sorted[i]
+        return None
+
+class DomainIndex:
+    """
+    Output sections of the domains of a region, in the order of the region.
+    For each of them:
+     - refs: the indexes of its domain and of the section in the domain;
+     - starts, ends: the addresses it occupies, from the kmemory or else from
+       the memreport;
+     - lows: the address of the last section of the previous domain (or of
+       the region), above which an address is placed in its domain.
+    """
+    def __init__(self, reg, sections):
+        self.refs, self.starts, self.ends, self.lows = [], [], [], []
+        low, start = reg['physical_address'], 0
+        for i, dom in enumerate(reg.get('domains', [])):
+            for j, os in enumerate(dom['output_sections']):
+                sec = sections[os['name']]
+                start = os['physical_address'] if 'physical_address' in os else sec.address
+                self.refs.append((i, j))
+                self.starts.append(start)
+                self.ends.append(start + sec.size)
+                self.lows.append(low)
+            low = start
+        self.ordered = all(a <= b for a, b in zip(self.ends, self.ends[1:]))
+
+    def find(self, address):
+        """
+        Returns the position of the first section that address falls in (or
+        before), or None if address is after all the sections.
+        """
+        k = bisect_right(self.ends, address) if self.ordered else 0
+        for k in range(k, len(self.ends)):
+            if self.lows[k] < address < self.ends[k]:
+                return k
+        return None
+
+def owner(element, sections):
+    """
+    Returns a function that gives the output sections of a domain that
+    belong to element, or None if the domain is not one of its domains.
+    """
+    if element['type'] == 'corunner':
+        def owned(dom):
+            if dom.get('identifier') in element['names']:
+                return {os['name'] for os in dom['output_sections']}
+            return None
+    else:
+        def owned(dom):
+            names = {os['name'] for os in dom['output_sections']
+                     if os['name'] in sections and
+                     sections[os['name']].id_name in element['names']}
+            return names or None
+    return owned
+
+def take_domains(kmem, element, sections):
+    """
+    Removes the domains of an element from the kmemory, and returns them as
+    (names, domain), where names are the output sections of the domain that
+    belong to the element.
+    """
+    owned = owner(element, sections)
+    taken = []
+    for reg in kmem['kmemory']['regions']:
+        if 'domains' not in reg:
+            continue
+        kept = []
+        for dom in reg['domains']:
+            names = owned(dom)
+            if names is None:
+                kept.append(dom)
+            else:
+                taken.append((names, dom))
+        reg['domains'][:] = kept
+    return taken
+
+def domain_size(names, sections):
+    return sum(sections[name].size for name in names)
+
+def check_section(sec):
+    assert set(sec.keys()).intersection({'region', 'address'}), \
+        "A least one of 'region', 'address' must be present in placement configuration"
+
+def find_region(layout, sec):
+    if 'region' in sec:
+        reg = layout.region(sec['region'])
+        assert reg is not None, f"Unknown region '{sec['region']}'"
+    else:
+        reg = layout.region_at(sec['address'])
+        assert reg is not None, f"No region at address {sec['address']:#x}"
+    return reg
+
+def holds(names, sec, sections):
+    return any(sections[name].type in sec['names'] for name in names)
+
+def select_domains(taken, sec, sections):
+    """
+    Returns copies of the domains taken that hold sections of the types of
+    sec, with their sizes.
+    """
+    chosen = [(names, dom) for names, dom in taken if holds(names, sec, sections)]
+    return ([deepcopy(dom) for _, dom in chosen],
+            [domain_size(names, sections) for names, _ in chosen])
+
+def append_domains(reg, domains):
+    """
+    Places domains at the end of a region, after its other domains.
+    """
+    if not reg['domains']:
+        domains[0]['output_sections'][0]['physical_address'] = reg['physical_address']
+    reg['domains'].extend(domains)
+
+def insert_domains(reg, domains, sizes, address, index):
+    """
+    Places domains at address in a region, whose domains are indexed by
+    index. If they overlap the domains that follow, these are moved after
+    them. Otherwise, or if address is after all the domains, they are simply
+    inserted.
+    """
+    k = index.find(address)
+    if k is None:
+        off = 0
+        for size, dom in zip(sizes, domains):
+            first = dom['output_sections'][0]
+            first['physical_address'] = address + off
+            off += size + align(first, True)
+        reg['domains'].extend(domains)
+        return
+
+    i, j = index.refs[k]
+    # The domains are laid from address, the last one first
+    off = 0
+    for size, dom in zip(sizes[::-1], domains[::-1]):
+        first = dom['output_sections'][0]
+        first['physical_address'] = address + off
+        off += size + align(first, True)
+    reg['domains'][i:i] = domains
+    start = index.starts[k]
+    if address <= start and off < start - address:
+        return
+
+    # Relocation of the sections that follow, which keep their alignment.
+    # The domains are copied before they are modified, so that the region
+    # may share them with other kmemories (see Sweep).
+    moved = set()
+    def section(i, j):
+        i += len(domains)
+        if i not in moved:
+            dom = reg['domains'][i]
+            reg['domains'][i] = dict(dom, output_sections=[dict(os) for os in dom['output_sections']])
+            moved.add(i)
+        return reg['domains'][i]['output_sections'][j]
+
+    os = section(i, j)
+    os['physical_address'] = address + off
+    align(os, j == 0)
+    for i, j in index.refs[k + 1:]:
+        if 'physical_address' in reg['domains'][i + len(domains)]['output_sections'][j]:
+            os = section(i, j)
+            os['physical_address'] += off
+            align(os, j == 0)
+
+def place_domains(reg, domains, sizes, sec, index=None):
+    if 'address' not in sec:
+        append_domains(reg, domains)
+    else:
+        insert_domains(reg, domains, sizes, sec['address'], index)
+
+def place_elements(kmem, memreport, elements):
+    """
+    Places the elements of a placement configuration in kmem, and returns
+    it. memreport is the memory report of a link with kmem.
+    """
+    sections = section_table(memreport)
+    layout = Layout(kmem)
+    for element in elements:
+        assert element['type'] in ELEMENT_TYPES
+        taken = take_domains(kmem, element, sections)
+        if not taken:
+            continue
+        for sec in element['sections']:
+            check_section(sec)
+            reg = find_region(layout, sec)
+            reg.setdefault('domains', [])
+            domains, sizes = select_domains(taken, sec, sections)
+            if domains:
+                place_domains(reg, domains, sizes, sec,
+                              DomainIndex(reg, sections) if 'address' in sec else None)
+    return kmem
+
+def gen_kmem(config, memreport, kmem):
+    """
+    Returns a copy of kmem, with the memory placement described by config.
+    config, memreport and kmem are the parsed placement configuration,
+    memory report and default kmemory.
+    """
+    return place_elements(deepcopy(kmem), memreport, config['elements'])
+
+def layout_sections(reg, sections):
+    """
+    Yields the output sections of the domains of a region with the interval
+    [start, end) they occupy once linked: a section without physical address
+    follows the previous one, at its alignment if it has one.
+    """
+    cursor = reg['physical_address']
+    for dom in reg.get('domains', []):
+        for os in dom['output_sections']:
+            if 'physical_address' in os:
+                cursor = os['physical_address']
+            elif psyko_alignment(os):
+                cursor += -cursor % psyko_alignment(os)
+            size = sections[os['name']].size if os['name'] in sections else 0
+            yield os, cursor, cursor + size
+            cursor += size
+
+# A conflict of a placement: its kind ("region", "alignment" or "overlap"),
+# the names of the output sections involved, and its description
+Conflict = namedtuple("Conflict", ["kind", "names", "message"])
+
+def conflict_keys(conflicts):
+    """
+    Returns what identifies conflicts whatever the addresses of their
+    sections: a placement that moves sections that already conflict still
+    has the same conflicts.
+    """
+    return {(conflict.kind, conflict.names) for conflict in conflicts}
+
+def check_kmem(kmem, memreport, base=None):
+    """
+    Returns the conflicts of the placement of a kmemory: output sections
+    that overlap, that are out of their region, or that are not at their
+    alignment (see psyko_alignment()). The sections have their size in
+    memreport, and are laid as by the linker (see layout_sections()).
+    If base is given, the conflicts it has already (e.g. the default
+    kmemory) are not reported.
+    """
+    sections = section_table(memreport)
+    conflicts = []
+    intervals = []
+    for reg in kmem['kmemory']['regions']:
+        low, high = reg['physical_address'], reg['physical_address'] + reg['size']
+        for os, start, end in layout_sections(reg, sections):
+            if start < low or end > high:
+                conflicts.append(Conflict("region", (os['name'],),
+                    f"{os['name']} [{start:#x}, {end:#x}) is out of "
+                    f"region {reg['name']} [{low:#x}, {high:#x})"))
+            alignment = psyko_alignment(os)
+            if alignment and start % alignment:
+                conflicts.append(Conflict("alignment", (os['name'],),
+                    f"{os['name']} at {start:#x} is not aligned on {alignment:#x}"))
+            if start < end:
+                intervals.append((start, end, os['name']))
+    # Each section is compared with the sections that start before it and
+    # are not over yet
+    intervals.sort()
+    active = []
+    for start, end, name in intervals:
+        active = [interval for interval in active if interval[1] > start]
+        for other in active:
+            conflicts.append(Conflict("overlap", tuple(sorted((name, other[2]))),
+                f"{name} [{start:#x}, {end:#x}) overlaps "
+                f"{other[2]} [{other[0]:#x}, {other[1]:#x})"))
+        active.append((start, end, name))
+    if base is not None:
+        known = conflict_keys(check_kmem(base, memreport))
+        conflicts = [conflict for conflict in conflicts
+                     if (conflict.kind, conflict.names) not in known]
+    return conflicts
+
+class Sweep:
+    """
+    Placements of the same elements at many addresses, as in the placement
+    campaigns of the run scripts: the configuration, memory report and
+    default kmemory are parsed and indexed once, and the domains of the
+    first element are taken once. The kmemory of each point shares the
+    domains that it does not move with the default kmemory.
+
+    The points are (task, corunner) addresses, at which all the sections of
+    the task or co-runner elements are placed together. None keeps the
+    placement of the configuration.
+    """
+    def __init__(self, config, memreport, kmem):
+        self.sections = section_table(memreport)
+        self.elements = config['elements']
+        for element in self.elements:
+            assert element['type'] in ELEMENT_TYPES
+            for sec in element['sections']:
+                check_section(sec)
+        self.base = deepcopy(kmem)
+        self.layout = Layout(self.base)
+        self.taken = take_domains(self.base, self.elements[0], self.sections) \
+            if self.elements else []
+        self.indexes = dict()
+
+    def sections_of(self, element, point):
+        task, corunner = point
+        address = task if element['type'] == 'task' else corunner
+        if address is None:
+            return element['sections']
+        names = [name for sec in element['sections'] for name in sec['names']]
+        return [{'names': sorted(set(names)), 'address': address}]
+
+    def check(self, point):
+        """
+        Returns the errors of the placement of a point that can be found
+        before it is generated: addresses out of the regions, elements that
+        overlap each other or the end of their region. The alignment of the
+        domains is not taken into account.
+        """
+        errors = []
+        blocks = []
+        for element in self.elements:
+            # The sizes of the domains of an element do not depend on the
+            # placement of the other elements
+            if element is self.elements[0]:
+                taken = self.taken
+            else:
+                owned = owner(element, self.sections)
+                taken = [(names, dom) for reg in self.layout.regions
+                         for dom in reg.get('domains', [])
+                         for names in [owned(dom)] if names is not None]
+            if not taken:
+                continue
+            for sec in self.sections_of(element, point):
+                if 'address' not in sec:
+                    continue
+                reg = self.layout.region(sec['region']) if 'region' in sec else \
+                    self.layout.region_at(sec['address'])
+                if reg is None:
+                    errors.append(f"{element['type']} {sec['names']}: no region at {sec['address']:#x}")
+                    continue
+                size = sum(domain_size(names, self.sections) for names, _ in taken
+                           if holds(names, sec, self.sections))
+                start, end = sec['address'], sec['address'] + size
+                if end > reg['physical_address'] + reg['size']:
+                    errors.append(f"{element['type']} {sec['names']}: [{start:#x}, {end:#x}) "
+                                  f"crosses the end of region {reg['name']}")
+                for other, other_start, other_end in blocks:
+                    if start < other_end and other_start < end:
+                        errors.append(f"{element['type']} {sec['names']}: [{start:#x}, {end:#x}) "
+                                      f"overlaps {other} [{other_start:#x}, {other_end:#x})")
+                blocks.append((f"{element['type']} {sec['names']}", start, end))
+        return errors
+
+    def kmemory(self, point):
+        """
+        Returns the kmemory of a point.
+        """
+        kmem = dict(self.base)
+        kmem['kmemory'] = dict(kmem['kmemory'])
+        kmem['kmemory']['regions'] = [
+            dict(reg, domains=list(reg['domains'])) if 'domains' in reg else dict(reg)
+            for reg in self.base['kmemory']['regions']]
+        layout = Layout(kmem)
+        # The index of a region of the default kmemory holds until the region
+        # is modified for the point: domains are only removed by take_domains()
+        # before, so it is modified if it has not the same number of domains.
+        placed = set()
+        def index_of(reg):
+            base = self.layout.region(reg['name'])
+            if reg['name'] in placed or \
+               len(reg['domains']) != len(base.get('domains', [])):
+                return DomainIndex(reg, self.sections)
+            if reg['name'] not in self.indexes:
+                self.indexes[reg['name']] = DomainIndex(reg, self.sections)
+            return self.indexes[reg['name']]
+
+        for element in self.elements:
+            if element is self.elements[0]:
+                taken = self.taken
+            else:
+                taken = take_domains(kmem, element, self.sections)
+            if not taken:
+                continue
+            for sec in self.sections_of(element, point):
+                reg = find_region(layout, sec)
+                reg.setdefault('domains', [])
+                domains, sizes = select_domains(taken, sec, self.sections)
+                if not domains:
+                    continue
+                index = index_of(reg) if 'address' in sec else None
+                placed.add(reg['name'])
+                place_domains(reg, domains, sizes, sec, index)
+        return kmem
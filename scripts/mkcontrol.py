@@ -3,7 +3,7 @@
 import argparse
 from pathlib import Path
 import sys
-from scriptutil import get_nodes_to_ea, decode_file, gen_json_data, calc
+from scriptutil import add_ea_index_options, check_ea_index_options, get_nodes_to_ea, decode_columns, gen_json_data, DATA_FORMATS, PLOT_BACKENDS, PLOT_BACKEND, sample_maxima, calc, R_READ_EA
 
 C0_OFF = "Task: C0, Corunner: OFF"
 C0_ON = "Task: C0, Corunner: ON"
@@ -14,9 +14,7 @@ C1_ON_LOCAL = "Task: C1, Corunner: ON (Local)"
 
 def getopts(argv):
     parser = argparse.ArgumentParser()
-    parser.add_argument("--kdbv", type=Path, required=True)
-    parser.add_argument("--kcfg", type=Path, required=True)
-    parser.add_argument("--kapp", type=Path, required=True)
+    add_ea_index_options(parser)
     parser.add_argument("--c0-off", type=Path, required=True)
     parser.add_argument("--c0-on", type=Path, required=True)
     parser.add_argument("--c0-on-local", type=Path, required=True)
@@ -25,26 +23,32 @@ def getopts(argv):
     parser.add_argument("--c1-on-local", type=Path, required=True)
     parser.add_argument("--output-dir", "-o", type=Path, required=True)
     parser.add_argument("--task", choices=["FLASH"], required=True)
+    parser.add_argument("--timer", type=float, required=True)
     parser.add_argument("--stats", action='store_true')
-    return parser.parse_args(argv[1:])
+    parser.add_argument("--format", choices=DATA_FORMATS, default="json",
+                        help="Format of the per-EA data files read by the R script")
+    parser.add_argument("--backend", choices=PLOT_BACKENDS, default=PLOT_BACKEND,
+                        help="Draw the figures with a generated R script, or directly with matplotlib")
+    args = parser.parse_args(argv[1:])
+    check_ea_index_options(parser, args)
+    return args
 
 
-def gen_r_script(data, out_dir):
+def gen_r_script(data, out_dir, fmt="json"):
     script = f"""
 library("rjson")
 library("vioplot")
 
 pdf(file="out.pdf", width=8, height=4)
 par(mfrow=c(2,2), mar=c(3,3,1,1))
-"""
+""" + R_READ_EA
 
     for core in ["1", "2"]:
         for ea in ["F1", "F2"]:
             cval = int(core) - 1
             script += f"""
 # For EA {ea} (core {core}) #########################
-result <- fromJSON(file = "{ea}.json")
-data <- as.data.frame(result)
+data <- read_ea("{ea}.{fmt}")
 
 g <- data[ data$group == "Core {core}" , ]
 # n: number of samples per plot
@@ -98,7 +102,7 @@ def gen_stats(data):
             C1_ON_LOCAL: 0.0,
         }
 
-        for value, sample in zip(info["values"], info["sample"]):
+        for sample, value in sample_maxima(info).items():
             assert sample in values, f"Unknown sample {sample}"
             values[sample] = max(values[sample], value)
 
@@ -158,12 +162,12 @@ def main(argv):
     ea_to_name, name_to_ea = get_nodes_to_ea(args)
 
     data = {
-        C0_OFF: decode_file(args.c0_off),
-        C0_ON: decode_file(args.c0_on),
-        C0_ON_LOCAL: decode_file(args.c0_on_local),
-        C1_OFF: decode_file(args.c1_off),
-        C1_ON: decode_file(args.c1_on),
-        C1_ON_LOCAL: decode_file(args.c1_on_local),
+        C0_OFF: decode_columns(args.c0_off, args.timer),
+        C0_ON: decode_columns(args.c0_on, args.timer),
+        C0_ON_LOCAL: decode_columns(args.c0_on_local, args.timer),
+        C1_OFF: decode_columns(args.c1_off, args.timer),
+        C1_ON: decode_columns(args.c1_on, args.timer),
+        C1_ON_LOCAL: decode_columns(args.c1_on_local, args.timer),
     }
 
     groups = {
@@ -175,8 +179,16 @@ def main(argv):
         C1_ON_LOCAL: ("Core 2", "ON", True),
     }
 
-    jdata = gen_json_data(data, ea_to_name, args.output_dir, groups)
-    gen_r_script(jdata, args.output_dir)
+    if args.backend == "matplotlib":
+        from plotting import ea_samples, plot_control
+        jdata = gen_json_data(data, ea_to_name, args.output_dir, groups, None)
+        plot_control(ea_samples(data, ea_to_name), args.output_dir,
+                     {1: C0_OFF, 2: C1_OFF},
+                     {1: C0_ON_LOCAL, 2: C1_ON_LOCAL},
+                     {1: C0_ON, 2: C1_ON})
+    else:
+        jdata = gen_json_data(data, ea_to_name, args.output_dir, groups, args.format)
+        gen_r_script(jdata, args.output_dir, args.format)
     if args.stats:
         gen_stats(jdata)
 
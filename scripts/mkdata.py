@@ -2,11 +2,10 @@
 
 import argparse
 from pathlib import Path
-import json
 import sys
 from os import environ
 
-from scriptutil import get_nodes_to_ea, decode_file, gen_json_data, calc, substi_temp
+from scriptutil import add_ea_index_options, check_ea_index_options, get_nodes_to_ea, decode_columns, gen_json_data, gen_json_dump, DATA_FORMATS, PLOT_BACKENDS, PLOT_BACKEND, ea_count, sample_maxima, calc, substi_temp, R_READ_EA
 
 P2020 = environ.get('P2020','power-qoriq-p2020-ds-p')
 MPC5777M = environ.get('MPC5777M',  'power-mpc5777m-evb')
@@ -16,8 +15,6 @@ C0_ON = "Task: C0, Corunner: ON"
 C1_OFF = "Task: C1, Corunner: OFF"
 C1_ON = "Task: C1, Corunner: ON"
 
-R_SCRIPT = str()
-
 LAYOUTS = {
     "G": [
         ["G0",  "G1",  "G2",  "G3"],
@@ -48,8 +45,7 @@ par(mfrow=c(${rows},${cols}), mar=c(3,3,1,1))
 
 EA_R_TEMPLATE = """
 # For EA ${ea} ##############################
-result <- fromJSON(file = "${ea}.json")
-data <- as.data.frame(result)
+data <- read_ea("${ea}.${fmt}")
 
 boxplot(
         values~sample,data=data,
@@ -108,9 +104,7 @@ def check_layout(layout):
 
 def getopts(argv):
     parser = argparse.ArgumentParser()
-    parser.add_argument("--kdbv", type=Path, required=True)
-    parser.add_argument("--kcfg", type=Path, required=True)
-    parser.add_argument("--kapp", type=Path, required=True)
+    add_ea_index_options(parser)
     parser.add_argument("--c0-off", type=Path, required=True)
     parser.add_argument("--c0-on", type=Path, required=True)
     parser.add_argument("--c1-off", type=Path, required=False)
@@ -120,19 +114,28 @@ def getopts(argv):
     parser.add_argument("--timer", type=float, required=True)
     parser.add_argument("--stats", action='store_true')
     parser.add_argument("--output-json", type=Path)
+    parser.add_argument("--format", choices=DATA_FORMATS, default="json",
+                        help="Format of the per-EA data files read by the R script")
+    parser.add_argument("--backend", choices=PLOT_BACKENDS, default=PLOT_BACKEND,
+                        help="Draw the figures with a generated R script, or directly with matplotlib")
     parser.add_argument("--product", "-p", type=str, required=True,
                         choices=[P2020,MPC5777M])
-    return parser.parse_args(argv[1:])
+    args = parser.parse_args(argv[1:])
+    check_ea_index_options(parser, args)
+    if args.output_json is not None and args.format != "json":
+        parser.error("--output-json requires --format json")
+    return args
 
 
-def gen_r_script(data, layout, out_dir):
+def gen_r_script(data, layout, out_dir, fmt="json"):
+    r_script = []
     def complete_script(template, context):
-        global R_SCRIPT
-        R_SCRIPT += substi_temp(template, context)
+        r_script.append(substi_temp(template, context))
 
     rows, cols = check_layout(layout)
     complete_script(R_SCRIPT_HEADER_TEMPLATE, {"rows": rows,
                                                "cols": cols})
+    r_script.append(R_READ_EA)
     ns = 0
     sets = 4
 
@@ -140,20 +143,19 @@ def gen_r_script(data, layout, out_dir):
         for ea in row:
             if ea is None:
                 continue
-            minval = min(data[ea]["values"])
-            maxval = max(data[ea]["values"])
-            n = int(len(data[ea]["values"]) / sets)
+            n = int(ea_count(data[ea]) / sets)
             ns += n
             complete_script(EA_R_TEMPLATE, {"ea": ea,
                                             "ea0": ea[0],
                                             "ea1_": ea[1:],
                                             "n": n,
-                                            "line": int(sets/2)})
+                                            "line": int(sets/2),
+                                            "fmt": fmt})
 
     complete_script(R_SCRIPT_FOOTER_TEMPLATE, {"ns": ns})
     out_dir.mkdir(parents=True, exist_ok=True)
     with open(out_dir / "plot.R", "w") as stream:
-        stream.write(R_SCRIPT)
+        stream.write(''.join(r_script))
 
 
 def gen_stats(data, cores, tex_name):
@@ -167,7 +169,7 @@ def gen_stats(data, cores, tex_name):
         values[C1_OFF] = 0.0
         values[C1_ON] = 0.0
 
-        for value, sample in zip(info["values"], info["sample"]):
+        for sample, value in sample_maxima(info).items():
             assert sample in values, f"Unknown sample {sample}"
             values[sample] = max(values[sample], value)
 
@@ -194,26 +196,25 @@ def gen_stats(data, cores, tex_name):
 def main(argv):
     """
     The data received is a dictionnary indexed by SOURCE and then by EA.
-    It contains a list of dictionaries where keys are:
-        - measure (the value in ms)
-        - esd: earliest start date in ms
-        - ddl: deadline in ms
+    It contains a dictionary of column arrays (one entry per measure) where
+    keys are:
+        - measure (the values in ms)
+        - esd: earliest start dates in us
+        - ddl: deadlines in us
         - src: index of the control node that starts the ea
-        - dst: index of the control node that closes:w the ea
+        - dst: index of the control node that closes the ea
 
     E.g.
 
         data = {
           "base": {
-            (1,4): [
-              {
-                measure: 0.33
-                esd: 32
-                ddl: 33
-                src: 1
-                dst: 4
-              }
-            ]
+            (1,4): {
+              measure: array([0.33, 0.34])
+              esd: array([32, 64])
+              ddl: array([33, 65])
+              src: array([1, 1])
+              dst: array([4, 4])
+            }
           }
         }
     """
@@ -223,8 +224,8 @@ def main(argv):
     #   (src,dst) => name
     ea_to_name, _ = get_nodes_to_ea(args)
     data = {
-        C0_OFF: decode_file(args.c0_off, args.timer),
-        C0_ON: decode_file(args.c0_on, args.timer),
+        C0_OFF: decode_columns(args.c0_off, args.timer),
+        C0_ON: decode_columns(args.c0_on, args.timer),
     }
 
     if args.product == P2020:
@@ -232,8 +233,8 @@ def main(argv):
     else:
         cores = [1, 2]
 
-    data[C1_OFF] = decode_file(args.c1_off, args.timer)
-    data[C1_ON] =  decode_file(args.c1_on, args.timer)
+    data[C1_OFF] = decode_columns(args.c1_off, args.timer)
+    data[C1_ON] =  decode_columns(args.c1_on, args.timer)
 
     layout = LAYOUTS[args.task]
 
@@ -245,14 +246,19 @@ def main(argv):
     groups[C1_OFF] = (f"Core {cores[1]}", "OFF", False)
     groups[C1_ON] = (f"Core {cores[1]}", "ON", False)
 
-    jdata = gen_json_data(data, ea_to_name, args.output_dir, groups)
-    gen_r_script(jdata, layout, args.output_dir)
+    if args.backend == "matplotlib":
+        from plotting import ea_samples, plot_data
+        fmt = "json" if args.output_json is not None else None
+        jdata = gen_json_data(data, ea_to_name, args.output_dir, groups, fmt)
+        plot_data(ea_samples(data, ea_to_name), layout, args.output_dir)
+    else:
+        jdata = gen_json_data(data, ea_to_name, args.output_dir, groups, args.format)
+        gen_r_script(jdata, layout, args.output_dir, args.format)
 
     if args.stats:
         gen_stats(jdata, cores, args.output_dir.resolve() / f"stats_{args.task}")
     if args.output_json is not None:
-        with open(args.output_json, "w") as outp:
-            json.dump(jdata, outp, indent=2)
+        gen_json_dump(args.output_dir, jdata, args.output_json)
 
 
 if __name__ == "__main__":
@@ -2,10 +2,9 @@
 
 import argparse
 from pathlib import Path
-import json
 import sys
 
-from scriptutil import calc
+from scriptutil import calc, sample_maxima, load_summary
 
 C0_OFF = "Task: C0, Corunner: OFF"
 C0_ON = "Task: C0, Corunner: ON"
@@ -38,7 +37,7 @@ def gen_stats(data):
         }
 
 
-        for value, sample in zip(info["values"], info["sample"]):
+        for sample, value in sample_maxima(info).items():
             assert sample in values, f"Unknown sample {sample}"
             values[sample] = max(values[sample], value)
 
@@ -68,10 +67,10 @@ def gen_stats(data):
 def main(argv):
     args = getopts(argv)
 
-    with open(args.file1, "r") as inp:
-        d1 = json.load(inp)
-    with open(args.file2, "r") as inp:
-        d2 = json.load(inp)
+    # Only the maxima of the samples are compared: the summaries written
+    # along with the dumps are enough, when they are up to date.
+    d1 = load_summary(args.file1)
+    d2 = load_summary(args.file2)
 
     def collect_values(info):
         values = {
@@ -80,7 +79,7 @@ def main(argv):
             C1_OFF: 0.0,
             C1_ON: 0.0,
         }
-        for value, sample in zip(info["values"], info["sample"]):
+        for sample, value in sample_maxima(info).items():
             assert sample in values, f"Unknown sample {sample}"
             values[sample] = max(values[sample], value)
         return values
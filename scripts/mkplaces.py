@@ -2,13 +2,13 @@
 
 import argparse
 from pathlib import Path
-import json
 import sys
 from os import environ
 from copy import deepcopy
+from concurrent.futures import ProcessPoolExecutor
 from sys import stderr
 
-from scriptutil import get_nodes_to_ea, decode_file, gen_json_data, calc, substi_temp, dump_json
+from scriptutil import add_ea_index_options, check_ea_index_options, get_nodes_to_ea, decode_columns, gen_json_data, gen_json_dump, DATA_FORMATS, PLOT_BACKENDS, PLOT_BACKEND, ea_count, sample_maxima, calc, substi_temp, load_json, R_READ_EA
 
 P2020 = environ.get('P2020','power-qoriq-p2020-ds-p')
 MPC5777M = environ.get('MPC5777M',  'power-mpc5777m-evb')
@@ -16,7 +16,6 @@ NVAL = int(environ.get('STUBBORN_MAX_MEASURES', '1024'))
 NO_SEP = bool(environ.get('NO_SEP', ''))
 IGN = environ.get('TRACE_IGN', '').split(':')
 
-R_SCRIPT = str()
 OF = 'out'
 
 LAYOUTS = {
@@ -51,8 +50,7 @@ par(xaxt="n")
 
 EA_R_TEMPLATE = """
 # For EA ${ea} ##############################
-result <- fromJSON(file = "${ea}.json")
-data <- as.data.frame(result)
+data <- read_ea("${ea}.${fmt}")
 n <- ${n}
 if(n == 1){
   plt <- plot
@@ -118,28 +116,74 @@ def check_layout(layout):
         assert len(row) == cols
     return rows, cols
 
+REQUIRED = ["traces_dir", "core", "output_dir", "task", "timer", "product"]
+PATHS = ["kdbv", "kcfg", "kapp", "ea_index", "traces_dir", "output_dir",
+         "output_json"]
+
 def getopts(argv):
+    """
+    Returns the list of campaigns to process: the one described on the
+    command line, or the ones listed in the --batch file. Each entry of the
+    batch file is an object whose keys are the long option names (e.g.
+    "traces-dir"); options given on the command line are used as defaults
+    for all the entries.
+    """
     parser = argparse.ArgumentParser()
-    parser.add_argument("--kdbv", type=Path, required=True)
-    parser.add_argument("--kcfg", type=Path, required=True)
-    parser.add_argument("--kapp", type=Path, required=True)
-    parser.add_argument("--traces-dir", type=Path, required=True)
-    parser.add_argument("--core", type=int, required=True)
+    add_ea_index_options(parser)
+    parser.add_argument("--traces-dir", type=Path)
+    parser.add_argument("--core", type=int)
     parser.add_argument("--corunner-core", type=int)
-    parser.add_argument("--output-dir", "-o", type=Path, required=True)
-    parser.add_argument("--task", choices=["G", "H", 'U'], required=True)
-    parser.add_argument("--timer", type=float, required=True)
+    parser.add_argument("--output-dir", "-o", type=Path)
+    parser.add_argument("--task", choices=list(LAYOUTS))
+    parser.add_argument("--timer", type=float)
     parser.add_argument("--stats", action='store_true')
     parser.add_argument("--output-json", type=Path)
-    parser.add_argument("--product", "-p", type=str, required=True,
+    parser.add_argument("--format", choices=DATA_FORMATS, default="json",
+                        help="Format of the per-EA data files read by the R script")
+    parser.add_argument("--backend", choices=PLOT_BACKENDS, default=PLOT_BACKEND,
+                        help="Draw the figures with a generated R script, or directly with matplotlib")
+    parser.add_argument("--product", "-p", type=str,
                         choices=[P2020,MPC5777M])
-    return parser.parse_args(argv[1:])
-
-
-def gen_r_script(data, layout, sets, out_dir):
+    parser.add_argument("--no-sep", action='store_true', default=NO_SEP)
+    parser.add_argument("--ignore", type=lambda s: s.split(':'), default=IGN)
+    parser.add_argument("--jobs", "-j", type=int, default=1,
+                        help="Number of processes used to decode the traces")
+    parser.add_argument("--batch", type=Path,
+                        help="JSON file listing the campaigns to process in a single run")
+    args = parser.parse_args(argv[1:])
+
+    jobs = [args]
+    if args.batch is not None:
+        jobs = []
+        for entry in load_json(args.batch):
+            job = deepcopy(args)
+            for key, val in entry.items():
+                key = key.replace('-', '_')
+                if key not in vars(args) or key == 'batch':
+                    parser.error(f"{args.batch}: unknown option '{key}'")
+                if key in PATHS:
+                    val = Path(val)
+                elif key == 'ignore' and isinstance(val, str):
+                    val = val.split(':')
+                setattr(job, key, val)
+            jobs.append(job)
+    for job in jobs:
+        for key in REQUIRED:
+            if getattr(job, key) is None:
+                parser.error(f"--{key.replace('_', '-')} is required")
+        check_ea_index_options(parser, job)
+        if job.output_json is not None and job.format != "json":
+            parser.error("--output-json requires --format json")
+        if job.task not in LAYOUTS:
+            parser.error(f"invalid task '{job.task}'")
+    return jobs
+
+
+def gen_r_script(data, layout, sets, out_dir, no_sep=NO_SEP, onefile=OF,
+                 fmt="json"):
+    r_script = []
     def complete_script(template, context):
-        global R_SCRIPT
-        R_SCRIPT += substi_temp(template, context)
+        r_script.append(substi_temp(template, context))
     def complete_test(ea, sets, task):
         complete_script(TESTS_R_TEMPLATE, {'ea0': ea[0],
                                         'ea1_': ea[1:],
@@ -150,7 +194,7 @@ def gen_r_script(data, layout, sets, out_dir):
     rows, cols = check_layout(layout)
     ns = 0
     m = 0
-    info_set = sorted(set(list(data.values())[0]['sample']))
+    info_set = sorted(sample_maxima(list(data.values())[0]))
     tests = {}
     ntests = len(info_set)
 
@@ -159,25 +203,27 @@ def gen_r_script(data, layout, sets, out_dir):
         if t not in tests.keys():
             tests[t] = list()
         tests[t].append(c)
-        if not NO_SEP:
+        if not no_sep:
             l = len(tests[t])
             if l > m:
                 m = l
-    if NO_SEP:
+    if no_sep:
         m = sets
 
     complete_script(R_SCRIPT_HEADER_TEMPLATE, {'rows': 1,
                                                'cols': 1,
                                                'sets': m,
-                                               'onefile': OF})
+                                               'onefile': onefile})
+    r_script.append(R_READ_EA)
 
 
     for ea in [g for r in layout for g in r if g]:
-        n = int(len(data[ea]["values"]) / sets)
+        n = int(ea_count(data[ea]) / sets)
         ns += n
         complete_script(EA_R_TEMPLATE, {'ea': ea,
-                                        'n': n})
-        if not NO_SEP:
+                                        'n': n,
+                                        'fmt': fmt})
+        if not no_sep:
             for task in tests.keys():
                 complete_test(ea, len(tests[task]), task)
         else:
@@ -188,7 +234,7 @@ def gen_r_script(data, layout, sets, out_dir):
                                                "nt": NVAL})
     out_dir.mkdir(parents=True, exist_ok=True)
     with open(out_dir / "plot.R", "w") as stream:
-        stream.write(R_SCRIPT)
+        stream.write(''.join(r_script))
 
 def gen_stats_header(d):
     cols = 0
@@ -203,13 +249,13 @@ def gen_stats_header(d):
                 subtitles = s + subtitles
             else:
                 subtitles += s
-      v[1] = substi_temp(LATEX_TASK_HEADER_TEMPLATE, {'title': title,
-                                                      'subtitles': subtitles})
+        v[1] = substi_temp(LATEX_TASK_HEADER_TEMPLATE, {'title': title,
+                                                        'subtitles': subtitles})
 
     return cols
 
 def gen_stats(data, layout, tex_name):
-    info_set = sorted(set(list(data.values())[0]['sample']))
+    info_set = sorted(sample_maxima(list(data.values())[0]))
     bvalues = {}
     tests = {}
     ntests = len(info_set)
@@ -226,7 +272,7 @@ def gen_stats(data, layout, tex_name):
     for ea in [g for r in layout for g in r if g]:
         info = data[ea]
         values = deepcopy(bvalues)
-        for value, sample in zip(info["values"], info["sample"]):
+        for sample, value in sample_maxima(info).items():
             assert sample in values, f"Unknown sample {sample}"
             values[sample] = max(values[sample], value)
         for k, v in tests.items():
@@ -248,34 +294,58 @@ def gen_stats(data, layout, tex_name):
         stream.write(text)
 
 def main(argv):
-  """
-  The data received is a dictionnary indexed by SOURCE and then by EA.
-  It contains a list of dictionaries where keys are:
-    - measure (the value in ms)
-    - esd: earliest start date in ms
-    - ddl: deadline in ms
-    - src: index of the control node that starts the ea
-    - dst: index of the control node that closes:w the ea
-
-  E.g.
-    data = {
-      "base": {
-        (1,4): [
-          {
-            measure: 0.33
-            esd: 32
-            ddl: 33
-            src: 1
-            dst: 4
+    """
+    The data received is a dictionnary indexed by SOURCE and then by EA.
+    It contains a dictionary of column arrays (one entry per measure) where
+    keys are:
+        - measure (the values in ms)
+        - esd: earliest start dates in us
+        - ddl: deadlines in us
+        - src: index of the control node that starts the ea
+        - dst: index of the control node that closes the ea
+
+    E.g.
+
+        data = {
+          "base": {
+            (1,4): {
+              measure: array([0.33, 0.34])
+              esd: array([32, 64])
+              ddl: array([33, 65])
+              src: array([1, 1])
+              dst: array([4, 4])
+            }
           }
-        ]
-      }
-    }
-  """
-    if IGN and IGN != ['']:
-        global OF
-        OF += '_zoomed'
-    args = getopts(argv)
+        }
+    """
+    for args in getopts(argv):
+        gen_campaign(args)
+
+
+# Traces already decoded, indexed by (path, timer): campaigns processed in the
+# same run share the traces they have in common.
+DECODED = dict()
+
+def decode_traces(files, timer, jobs=1):
+    """
+    Decodes the given traces, fanned out to a pool of processes when more
+    than one job is requested. Results are returned in the order of files.
+    """
+    todo = [f for f in files if (f, timer) not in DECODED]
+    if jobs > 1 and len(todo) > 1:
+        with ProcessPoolExecutor(jobs) as pool:
+            decoded = list(pool.map(decode_columns, todo, [timer] * len(todo),
+                                    chunksize=max(1, len(todo) // (4 * jobs))))
+    else:
+        decoded = [decode_columns(f, timer) for f in todo]
+    for f, columns in zip(todo, decoded):
+        DECODED[(f, timer)] = columns
+    return [DECODED[(f, timer)] for f in files]
+
+def gen_campaign(args):
+    onefile = OF
+    if args.ignore and args.ignore != ['']:
+        onefile += '_zoomed'
     if args.corunner_core == None:
         args.corunner_core = abs(1-args.core)
     cores = [args.core, args.corunner_core]
@@ -287,25 +357,34 @@ def main(argv):
 
     data = {}
     groups = {}
-    print(IGN)
-    for f in args.traces_dir.iterdir():
-        if f.suffix == '.bin':
-            name = str(f.stem).upper()
-            if name not in IGN:
-                print(name)
-                data[name] = decode_file(f, args.timer)
-                groups[name] = (f"Core {cores[0]}", "ON", False)
+    print(args.ignore)
+    # Sorted by stem, so that samples always come in the same order
+    files = sorted((f for f in args.traces_dir.iterdir()
+                    if f.suffix == '.bin' and f.stem.upper() not in args.ignore),
+                   key=lambda f: f.stem)
+    for f, columns in zip(files, decode_traces(files, args.timer, args.jobs)):
+        name = str(f.stem).upper()
+        print(name)
+        data[name] = columns
+        groups[name] = (f"Core {cores[0]}", "ON", False)
     layout = LAYOUTS[args.task]
 
-    jdata = gen_json_data(data, ea_to_name, args.output_dir, groups)
-    gen_r_script(jdata, layout, len(data), args.output_dir)
+    if args.backend == "matplotlib":
+        from plotting import ea_samples, plot_places
+        fmt = "json" if args.output_json is not None else None
+        jdata = gen_json_data(data, ea_to_name, args.output_dir, groups, fmt)
+        plot_places(ea_samples(data, ea_to_name), layout, args.output_dir,
+                    args.no_sep, onefile)
+    else:
+        jdata = gen_json_data(data, ea_to_name, args.output_dir, groups, args.format)
+        gen_r_script(jdata, layout, len(data), args.output_dir,
+                     args.no_sep, onefile, args.format)
 
     if args.stats:
         pass
         #gen_stats(jdata, layout, args.output_dir.resolve() / f"stats_{args.task}")
     if args.output_json is not None:
-        with open(args.output_json, "w") as outp:
-            dump_json(jdata, outp)
+        gen_json_dump(args.output_dir, jdata, args.output_json)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,136 @@
+# This file is imported by the mk*.py scripts when they render the figures
+# themselves (--backend matplotlib), instead of generating a R script.
+# The figures follow the layouts of the R scripts, but are drawn from the
+# decoded measures, without going through the per-EA files.
+
+import numpy as np
+import matplotlib
+matplotlib.use("Agg")
+from matplotlib import pyplot as plt
+from matplotlib.backends.backend_pdf import PdfPages
+
+def ea_samples(data, ea_to_name):
+    """
+    Rearranges the decoded data (indexed by sample, then by EA) as a
+    dictionary indexed by EA name, then by sample, of the measures.
+    """
+    samples = dict()
+    for sample, sample_data in data.items():
+        for ea, ea_values in sample_data.items():
+            samples.setdefault(ea_to_name[ea], dict())[sample] = ea_values["measure"]
+    return samples
+
+def ea_title(ea, n, pos=""):
+    # Same as the R expression: ea0[ea1_] ~ "(n=..., pos=...)"
+    pos = f", pos={pos}" if pos else ""
+    return f"${ea[0]}_{{{ea[1:]}}}$ (n={n}{pos})"
+
+def distributions(ax, series, violin=True):
+    """
+    Draws the distribution of each series at positions 1..len(series): a
+    violin, or the points themselves when violin is False.
+    Series whose values are all identical are drawn as a horizontal bar,
+    since there is no distribution to estimate.
+    """
+    positions = range(1, len(series) + 1)
+    if not violin:
+        for pos, values in zip(positions, series):
+            ax.plot([pos] * len(values), values, "o", color="black")
+        return
+    spread = [(pos, v) for pos, v in zip(positions, series) if np.ptp(v) > 0]
+    if spread:
+        parts = ax.violinplot([v for _, v in spread], [p for p, _ in spread],
+                              showmedians=True)
+        for body in parts["bodies"]:
+            body.set_facecolor("grey")
+            body.set_edgecolor("black")
+        for part in ("cmins", "cmaxes", "cbars", "cmedians"):
+            parts[part].set_color("black")
+    for pos, values in zip(positions, series):
+        if not np.ptp(values) > 0:
+            ax.hlines(values[0], pos - 0.4, pos + 0.4, color="black")
+
+def plot_data(samples, layout, out_dir):
+    """
+    mkdata.py: one box plot per EA of the layout, with the measures of
+    each sample jittered on top of it.
+    """
+    rows, cols = len(layout), len(layout[0])
+    fig, axes = plt.subplots(rows, cols, figsize=(7, 7), squeeze=False)
+    rng = np.random.default_rng(0)
+    for row, ea_row in zip(axes, layout):
+        for ax, ea in zip(row, ea_row):
+            if ea is None:
+                ax.set_axis_off()
+                continue
+            levels = sorted(samples[ea])
+            series = [samples[ea][level] for level in levels]
+            n = int(sum(len(v) for v in series) / len(series))
+            ax.boxplot(series, patch_artist=True,
+                       boxprops={"facecolor": (0.5, 0.5, 0.5, 0.4)})
+            for pos, values in enumerate(series, 1):
+                width = len(values) / (n * len(series)) / 2
+                ax.plot(pos + rng.uniform(-width, width, len(values)), values,
+                        ".", color=(0, 0, 0, 0.7))
+            ax.axvline(len(series) / 2 + 0.5, color="grey")
+            ax.set_xticks(range(1, len(series) + 1),
+                          [f"({chr(ord('a') + i)})" for i in range(len(series))])
+            ax.set_title(ea_title(ea, n), fontsize="small")
+            ax.set_ylabel("Time (ms)", fontsize="small")
+            ax.tick_params(labelsize="x-small")
+    fig.tight_layout()
+    out_dir.mkdir(parents=True, exist_ok=True)
+    fig.savefig(out_dir / "out.pdf")
+    plt.close(fig)
+
+def plot_places(samples, layout, out_dir, no_sep, onefile):
+    """
+    mkplaces.py: one page per EA of the layout and per test (the part of
+    the sample name before '-'), or a single page per EA with all the
+    samples if no_sep is set. EAs with a single measure per sample are
+    drawn as points rather than violins.
+    """
+    out_dir.mkdir(parents=True, exist_ok=True)
+    with PdfPages(out_dir / f"{onefile}.pdf") as pdf:
+        for ea in [g for r in layout for g in r if g]:
+            levels = sorted(samples[ea])
+            n = int(sum(len(samples[ea][l]) for l in levels) / len(levels))
+            if no_sep:
+                pages = {"": levels}
+            else:
+                pages = dict()
+                for level in levels:
+                    pages.setdefault(level.split('-')[0], []).append(level)
+            for task, page in pages.items():
+                sets = len(page)
+                fig, ax = plt.subplots(figsize=(max(7.5, sets), 7.5))
+                distributions(ax, [samples[ea][l] for l in page], violin=n != 1)
+                for pos in range(1, sets + 1):
+                    ax.axvline(pos, color="black", linestyle="dotted")
+                ax.set_xticks(range(1, sets + 1), page, rotation=35,
+                              ha="right", fontsize="small")
+                ax.set_ylabel("Time (ms)")
+                ax.set_title(ea_title(ea, n, task[1:]))
+                fig.tight_layout()
+                pdf.savefig(fig)
+                plt.close(fig)
+
+def plot_control(samples, out_dir, off, on_local, on):
+    """
+    mkcontrol.py: for each core and EA F1/F2, the violins of the measures
+    without co-runner, with local co-runners and with co-runners. off,
+    on_local and on are the sample names, indexed by core (1 or 2).
+    """
+    fig, axes = plt.subplots(2, 2, figsize=(8, 4), squeeze=False)
+    for row, core in zip(axes, [1, 2]):
+        for ax, ea in zip(row, ["F1", "F2"]):
+            series = [samples[ea][sample[core]] for sample in (off, on_local, on)]
+            distributions(ax, series)
+            ax.set_xticks(range(1, 4), ["1", "2", "3"])
+            ax.set_xlabel(f"{ea} (core={core}, n={len(series[0])})", fontsize="small")
+            ax.set_ylabel("Time (ms)", fontsize="small")
+            ax.tick_params(labelsize="x-small")
+    fig.tight_layout()
+    out_dir.mkdir(parents=True, exist_ok=True)
+    fig.savefig(out_dir / "out.pdf")
+    plt.close(fig)
@@ -88,6 +88,7 @@ run() {
     --core "$core" \
     --build-dir "$build_dir" \
     --product "$PRODUCT" \
+    --jobs "${BUILD_JOBS:-1}" \
     $extra_opts
 
 #   And now, call a hook script to control the execution of trace32
@@ -159,25 +159,40 @@ generate_R() {
         ;;
       "H")
         extra_args="
+                      --format json \\
                       --output-json '$TRACES_DIR/$TYPE.json'
         "
         ;;
     esac
   fi
+  ea_index="$BUILD_DIR/$1/$ref/ea_index.json"
+  if [ -f "$ea_index" ]; then
+    dbs="
+                  --ea-index '$ea_index' \\
+    "
+  else
+    dbs="
+                  --kdbv '$KDBV' \\
+                  --kcfg '$BUILD_DIR/$1/$ref/gen/app/partos/0/dbs/task_$1_kcfg.ks' \\
+                  --kapp '$BUILD_DIR/$1/$ref/gen/app/config/kapp.ks' \\
+    "
+  fi
   eval "
   './scripts/$script' \\
         \\$bins \\
-        --kdbv '$KDBV' \\
-        --kcfg '$BUILD_DIR/$1/$ref/gen/app/partos/0/dbs/task_$1_kcfg.ks' \\
-        --kapp '$BUILD_DIR/$1/$ref/gen/app/config/kapp.ks' \\
+        \\$dbs \\
         --output-dir '$OUTDIR/$TYPE' --task=$1 \\
         --product '$PRODUCT'\\
         --timer '$timer' \\
+        --format csv \\
         $sym \\
         \\$extra_args
   "
-   cd "$OUTDIR/$TYPE"
-   R --no-save < plot.R
+   # With PLOT_BACKEND=matplotlib, the script above already drew out.pdf
+   if [ "${PLOT_BACKEND:-r}" = "r" ]; then
+     cd "$OUTDIR/$TYPE"
+     R --no-save < plot.R
+   fi
 }
 if [ "x$TYPE" = x"flash" ]; then
   cmd='run_flash'
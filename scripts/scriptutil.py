@@ -3,12 +3,21 @@
 import json
 from collections import namedtuple
 import tempfile
-import struct
+import mmap
+import hashlib
+import numpy as np
 from subprocess import PIPE, run, TimeoutExpired, CalledProcessError
 from string import Template
 from sys import exit, stderr
-from time import sleep
+from time import sleep, time, perf_counter
+from contextlib import contextmanager
+import random
+import fcntl
+from threading import Lock, get_ident
 from io import IOBase
+from os import fstat, replace, environ, getpid, utime, umask, fchmod
+from shutil import which, copyfileobj, copyfile
+from pathlib import Path
 
 EA = namedtuple("EA", ["source", "target"])
 
@@ -31,84 +40,285 @@ def substi_temp(template, context):
     return Template(template).substitute(context)
 
 def write_template(output_filename, template, context):
-    output_filename.parent.mkdir(exist_ok=True, parents=True)
-    with open(output_filename, "w") as fileh:
-        fileh.write(substi_temp(template, context))
-
-def decode_file(input_file, timer):
-    sorted_data = dict()
-
-    # Data format is simple: 16-bits, 16-bits, 32-bits, 64-bits 64-bits
-    # If the first two fields are zero, data stream is finished.
-    data_format = ">2HI2Q"
-    item_size = struct.calcsize(data_format)
-    offset = 0
-    count = 0
-    all_time = 0
+    with profile_step("template", output_filename.name):
+        output_filename.parent.mkdir(exist_ok=True, parents=True)
+        with open(output_filename, "w") as fileh:
+            fileh.write(substi_temp(template, context))
+
+# Data format is simple: 16-bits, 16-bits, 32-bits, 64-bits 64-bits
+# If the first two fields are zero, data stream is finished.
+TRACE_DTYPE = np.dtype([
+    ("src", ">u2"),
+    ("dst", ">u2"),
+    ("val", ">u4"),
+    ("esd", ">u8"),
+    ("ddl", ">u8"),
+])
+
+COLUMNS = ("measure", "esd", "ddl", "src", "dst")
+
+# Bump whenever the layout of the per-EA files written by gen_json_data()
+# changes, so that files written by an older version are not reused.
+JDATA_FORMAT = 2
+
+def group_columns(flat):
+    """
+    Groups the decoded columns (in record order) by EA, in order of first
+    appearance. Returns a dictionary indexed by EA whose values are
+    dictionaries of column arrays (one entry per measure of the EA).
+    """
+    keys = (flat["src"].astype(np.uint32) << 16) | flat["dst"]
+    # A stable sort keeps the record order within each EA
+    order = np.argsort(keys, kind='stable')
+    bounds = np.flatnonzero(np.diff(keys[order])) + 1
+    groups = np.split(order, bounds) if len(order) else []
+    columns = dict()
+    for idx in sorted(groups, key=lambda idx: idx[0]):
+        key = int(keys[idx[0]])
+        ea = EA(source=key >> 16, target=key & 0xffff)
+        columns[ea] = {col: flat[col][idx] for col in COLUMNS}
+    return columns
+
+def map_trace(input_file):
+    """
+    Maps a stubborn measure dump in memory and returns its records as a
+    structured array backed by the mapping: nothing is copied, pages are only
+    read when accessed. Records following the zero terminator (src == dst ==
+    0) are not part of the stream and are left out.
+    """
     with open(input_file, 'rb') as stream:
-        contents = stream.read()
-
-    while offset < len(contents):
-        src, dst, val, esd, ddl = struct.unpack_from(data_format, contents, offset)
-        offset += item_size
-        count += 1
-
+        count = fstat(stream.fileno()).st_size // TRACE_DTYPE.itemsize
+        if not count:
+            return np.empty(0, dtype=TRACE_DTYPE)
+        buf = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+    records = np.frombuffer(buf, dtype=TRACE_DTYPE, count=count)
+    end = np.flatnonzero((records["src"] == 0) & (records["dst"] == 0))
+    if len(end):
+        records = records[:end[0]]
+    return records
+
+def decode_records(records, timer):
+    """
+    Converts the records of a dump into flat columns, in record order.
+    """
+    return {
         # Val is the number of quota timer ticks.
         #   Time_s = NbTicks / Freq_Hz
         #
         # The ticker ticks at 5MHz for the MPC5777m and at 75MHz for the P2020.
         # We want a result in ms, so we * 1e3
-        val_ms = float(val) / timer * 1e3
-        all_time += val_ms
-
+        "measure": records["val"].astype(np.float64) / timer * 1e3,
         # Esd/Ddl are in ns. Convert to us.
-        esd = float(esd) / 1e3
-        ddl = float(ddl) / 1e3
-
-        ea = EA(source=src, target=dst)
-
-        if not ea in sorted_data:
-            print(f"=> {ea} ({src} -> {dst})")
-            sorted_data[ea] = []
-        sorted_data[ea].append({
-            "measure": val_ms,
-            "esd": esd,
-            "ddl": ddl,
-            "src": src,
-            "dst": dst,
-        })
-
-    print(f"{count} measures processed, {len(contents)}, {input_file}")
-    print(f"{all_time} ms of run-time, with quota timer of {timer:.1E}Mhz")
-    return sorted_data
+        "esd": records["esd"].astype(np.float64) / 1e3,
+        "ddl": records["ddl"].astype(np.float64) / 1e3,
+        "src": records["src"].astype(np.uint16),
+        "dst": records["dst"].astype(np.uint16),
+    }
+
+def decode_columns(input_file, timer):
+    """
+    Decodes a stubborn measure dump in a single pass over the whole buffer.
+    Returns a dictionary indexed by EA of per-EA column arrays:
+      - measure: execution times, in ms
+      - esd: earliest start dates, in us
+      - ddl: deadlines, in us
+      - src: index of the control node that starts the EA
+      - dst: index of the control node that closes the EA
+    """
+    flat = decode_records(map_trace(input_file), timer)
+    columns = group_columns(flat)
+    count = len(flat["measure"])
+    for ea in columns:
+        print(f"=> {ea} ({ea.source} -> {ea.target})")
+    print(f"{count} measures processed, {count * TRACE_DTYPE.itemsize}, {input_file}")
+    print(f"{flat['measure'].sum()} ms of run-time, with quota timer of {timer:.1E}Mhz")
+    return columns
+
+def columns_to_records(columns):
+    """
+    Compatibility view of decode_columns(): returns, for each EA, the list of
+    dictionaries (one per measure) historically produced by decode_file().
+    """
+    records = dict()
+    for ea, cols in columns.items():
+        records[ea] = [
+            {"measure": m, "esd": e, "ddl": d, "src": s, "dst": t}
+            for m, e, d, s, t in zip(cols["measure"].tolist(),
+                                     cols["esd"].tolist(),
+                                     cols["ddl"].tolist(),
+                                     cols["src"].tolist(),
+                                     cols["dst"].tolist())
+        ]
+    return records
 
+def decode_file(input_file, timer):
+    return columns_to_records(decode_columns(input_file, timer))
+
+
+# Databases dumped by kdbv are cached in memory and on disk. Entries are keyed
+# by the content of the database and by the identity (path, size, modification
+# time) of the kdbv binary: a database written again with the same content
+# (e.g. the memory report of each build) reuses the entry of the previous one.
+# Only the KDBV_CACHE_SIZE entries used last are kept on disk.
+KDBV_CACHE_DIR = Path(environ.get('KDBV_CACHE_DIR',
+    Path(environ.get('XDG_CACHE_HOME', Path.home() / '.cache')) / 'corunners' / 'kdbv'))
+NO_KDBV_CACHE = bool(environ.get('NO_KDBV_CACHE', ''))
+KDBV_CACHE_SIZE = int(environ.get('KDBV_CACHE_SIZE', '256'))
+DBS = dict()
+
+def file_identity(path):
+    path = Path(path).resolve()
+    st = path.stat()
+    return f"{path}:{st.st_size}:{st.st_mtime_ns}"
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as stream:
+        for chunk in iter(lambda: stream.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def db_cache_file(kdbv, path_to_db):
+    # <digest of the database>-<digest of the identity of kdbv>.json
+    kdbv = which(kdbv) or kdbv
+    tool = hashlib.sha256(file_identity(kdbv).encode()).hexdigest()
+    return KDBV_CACHE_DIR / f"{file_digest(path_to_db)}-{tool}.json"
+
+def prune_db_cache():
+    # The modification time of an entry is the last time it was used
+    entries = []
+    for cache_file in KDBV_CACHE_DIR.glob('*.json'):
+        try:
+            entries.append((cache_file.stat().st_mtime_ns, cache_file))
+        except FileNotFoundError:
+            pass
+    entries.sort()
+    for _, cache_file in entries[:max(0, len(entries) - KDBV_CACHE_SIZE)]:
+        try:
+            cache_file.unlink()
+        except FileNotFoundError:
+            pass
 
 def load_db(kdbv, path_to_db):
-    proc = run([kdbv, path_to_db], stdout=PIPE, check=True)
-    return load_json(proc.stdout, o=False)
-
-
-def get_nodes_to_ea(args):
-    kcfg = load_db(args.kdbv, args.kcfg)
-    kapp = load_db(args.kdbv, args.kapp)
-
-    nodes_to_ea = dict()
-    name_to_id = dict()
-
+    cache_file = db_cache_file(kdbv, path_to_db)
+    if cache_file in DBS:
+        return DBS[cache_file]
+    db = None
+    if not NO_KDBV_CACHE:
+        try:
+            db = load_json(cache_file)
+            utime(cache_file)
+        except (OSError, ValueError):
+            pass
+    if db is None:
+        proc = run([kdbv, path_to_db], stdout=PIPE, check=True)
+        db = load_json(proc.stdout, o=False)
+        if not NO_KDBV_CACHE:
+            write_atomic(cache_file, json.dumps(db, separators=(',', ':')))
+            prune_db_cache()
+    DBS[cache_file] = db
+    return db
+
+def clear_db_cache(kdbv=None, path_to_db=None):
+    """
+    Drops the cached dump of path_to_db by kdbv (by any kdbv if it is not
+    given), or the whole cache if no database is given.
+    """
+    if path_to_db is None:
+        cache_files = list(KDBV_CACHE_DIR.glob('*.json'))
+    elif kdbv is None:
+        cache_files = list(KDBV_CACHE_DIR.glob(f"{file_digest(path_to_db)}-*.json"))
+    else:
+        cache_files = [db_cache_file(kdbv, path_to_db)]
+    for cache_file in cache_files:
+        DBS.pop(cache_file, None)
+        try:
+            cache_file.unlink()
+        except FileNotFoundError:
+            pass
+    if path_to_db is None:
+        DBS.clear()
+
+# Temporary files are only readable by their owner: the files written in
+# their place get the mode of a file created by open() instead. The umask can
+# only be read by setting it, which is done once, before any thread starts.
+UMASK = umask(0)
+umask(UMASK)
+
+def publish(stream):
+    fchmod(stream.fileno(), 0o666 & ~UMASK)
+
+def write_atomic(path, text):
+    # Write then rename, so that a concurrent reader never sees a partial file
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile('w', dir=path.parent, delete=False) as stream:
+            stream.write(text)
+            publish(stream)
+        replace(stream.name, path)
+    except OSError as e:
+        print(f"Cannot write {path}: {e}", file=stderr)
+
+
+# Version of the EA index format written by gen_ea_index()
+EA_INDEX_VERSION = 1
+
+def make_ea_index(kcfg, kapp, task):
+    """
+    Builds the EA index of a task from its kcfg and the kapp databases:
+      - nodes: control node name => global index
+      - eas: EA name => [source node index, target node index]
+    """
+    nodes = dict()
     cg = kcfg["control_graph"]
     for cg_node in cg["nodes"]:
         assert cg_node["type"] == "ADVANCE"
-        name = cg_node["name"]
-        name_to_id[name] = cg_node["global_index"]
+        nodes[cg_node["name"]] = cg_node["global_index"]
 
+    eas = dict()
     for ag in kapp["agents"]:
-        if ag["name"] != f"task_{args.task}":
+        if ag["name"] != f"task_{task}":
             continue
         for ea in ag["eas"]:
-            src = name_to_id[ea["from"]]
-            dst = name_to_id[ea["to"]]
-            ea_tuple = EA(source=src, target=dst)
-            nodes_to_ea[ea_tuple] = ea["name"]
+            eas[ea["name"]] = [nodes[ea["from"]], nodes[ea["to"]]]
+
+    return {
+        "version": EA_INDEX_VERSION,
+        "task": task,
+        "nodes": nodes,
+        "eas": eas,
+    }
+
+def gen_ea_index(kdbv, kcfg, kapp, task, output):
+    index = make_ea_index(load_db(kdbv, kcfg), load_db(kdbv, kapp), task)
+    dump_json(index, output)
+    return index
+
+def add_ea_index_options(parser):
+    parser.add_argument("--kdbv", type=Path)
+    parser.add_argument("--kcfg", type=Path)
+    parser.add_argument("--kapp", type=Path)
+    parser.add_argument("--ea-index", type=Path,
+                        help="EA index generated by build.py (ea_index.json), replaces --kdbv, --kcfg and --kapp")
+
+def check_ea_index_options(parser, args):
+    if args.ea_index is None and None in (args.kdbv, args.kcfg, args.kapp):
+        parser.error("either --ea-index or all of --kdbv, --kcfg and --kapp are required")
+
+def get_nodes_to_ea(args):
+    if args.ea_index is not None:
+        index = load_json(args.ea_index)
+        assert index["version"] == EA_INDEX_VERSION, \
+            f"{args.ea_index}: unsupported EA index version {index['version']}"
+        assert index["task"] == args.task, \
+            f"{args.ea_index}: EA index of task {index['task']}, not {args.task}"
+    else:
+        index = make_ea_index(load_db(args.kdbv, args.kcfg),
+                              load_db(args.kdbv, args.kapp), args.task)
+
+    nodes_to_ea = dict()
+    for name, (src, dst) in index["eas"].items():
+        nodes_to_ea[EA(source=src, target=dst)] = name
 
     assert len(nodes_to_ea) != 0
 
@@ -118,80 +328,427 @@ def get_nodes_to_ea(args):
     return nodes_to_ea, ea_to_nodes
 
 
-def gen_json_data(data, ea_to_name, out_dir, groups):
-    # See the main function to understand how "data" is structured
-    # In the end, the JSON data must look like this:
+# Columns of the per-EA files holding the group of each measure
+CATEGORICAL = ("group", "sample", "corunner", "local")
+
+# Reads a per-EA file written by gen_json_data() as a data frame. To be
+# appended to the generated R scripts.
+R_READ_EA = """
+read_ea <- function(file) {
+  if (endsWith(file, ".csv")) {
+    if (requireNamespace("data.table", quietly = TRUE)) {
+      return(as.data.frame(data.table::fread(file, stringsAsFactors = TRUE)))
+    }
+    return(read.csv(file, colClasses = c("numeric", "factor", "factor", "factor", "logical")))
+  }
+  cols <- lapply(fromJSON(file = file), function(col) {
+    if (!is.list(col)) {
+      return(col)
+    }
+    v <- rep(col$levels[col$codes + 1], col$lengths)
+    if (is.character(v)) factor(v) else v
+  })
+  as.data.frame(cols)
+}
+"""
+
+# Formats of the per-EA files written by gen_json_data()
+DATA_FORMATS = ("json", "csv")
+
+# Figures are drawn either by the generated R scripts (plot.R), or directly
+# by the mk*.py scripts with matplotlib (see plotting.py).
+PLOT_BACKENDS = ("r", "matplotlib")
+PLOT_BACKEND = environ.get('PLOT_BACKEND', 'r')
+
+def csv_field(value):
+    if isinstance(value, bool):
+        return "TRUE" if value else "FALSE"
+    if isinstance(value, str):
+        return '"' + value.replace('"', '""') + '"'
+    return repr(value)
+
+def gen_json_data(data, ea_to_name, out_dir, groups, fmt="json"):
+    # "data" is indexed by sample, then by EA, as returned by decode_columns()
+    # Each EA is written to its own file, incrementally as samples are
+    # processed. Categorical columns are run-length encoded: a dictionary of
+    # the distinct values ("levels"), then for each run the index of its
+    # value ("codes") and its length ("lengths"). In the end, the JSON data
+    # of an EA looks like this:
     #  {
-    #    "EA0": {
-    #      "values": [
-    #        1,2,3,4,
-    #        8,4,3,4,
-    #        1,2,3,4,
-    #        5,2,3,5
-    #      ],
-    #      "group": [
-    #        "(A)", "(A)", "(A)", "(A)",
-    #        "(A)", "(A)", "(A)", "(A)",
-    #        "(B)", "(B)", "(B)", "(B)",
-    #        "(B)", "(B)", "(B)", "(B)"
-    #      ],
-    #      "sample": [
-    #        1,1,1,1,
-    #        2,2,2,2,
-    #        4,4,4,4,
-    #        3,3,3,3
-    #      ]
-    #      "corunner": [
-    #        OFF, OFF, OFF, OFF,
-    #        ON, ON, ON, ON,
-    #        OFF, OFF, OFF, OFF,
-    #        ON, ON, ON, ON,
-    #      ]
-    #      "local": [
-    #        True, True, True, True,
-    #        True, True, True, True,
-    #        True, True, True, True,
-    #        False, False, False, False,
-    #      ]
-    #    }
-    #    ...
+    #    "values": [
+    #      1,2,3,4,
+    #      8,4,3,4,
+    #      1,2,3,4,
+    #      5,2,3,5
+    #    ],
+    #    "group": {"levels": ["(A)", "(B)"], "codes": [0, 1], "lengths": [8, 8]},
+    #    "sample": {"levels": [1, 2, 4, 3], "codes": [0, 1, 2, 3], "lengths": [4, 4, 4, 4]},
+    #    "corunner": {"levels": ["OFF", "ON"], "codes": [0, 1, 0, 1], "lengths": [4, 4, 4, 4]},
+    #    "local": {"levels": [true, false], "codes": [0, 1], "lengths": [12, 4]}
     #  }
+    #
+    # With fmt="csv", each EA is written as a CSV file instead, with one row
+    # per measure and the columns values,group,sample,corunner,local.
+    #
+    # Returns, for each EA, the number of measures, the maximum measure of
+    # each sample and the categorical columns.
+
+    def append_run(col, value, length):
+        if col["levels"] and col["levels"][col["codes"][-1]] == value:
+            col["lengths"][-1] += length
+            return
+        if value not in col["levels"]:
+            col["levels"].append(value)
+        col["codes"].append(col["levels"].index(value))
+        col["lengths"].append(length)
+
+    # Rewriting the files is by far the most expensive part: skip it when
+    # they were generated from the very same data.
+    # With fmt=None, no file is written at all and only the summary is
+    # returned (e.g. when the figures are not drawn by R).
+    key_file = out_dir / ".jdata.key"
+    if fmt is None:
+        up_to_date = True
+    else:
+        key = jdata_digest(data, ea_to_name, groups, fmt)
+        ea_names = {ea_to_name[ea] for sample_data in data.values() for ea in sample_data}
+        up_to_date = key_file.is_file() and key_file.read_text() == key and \
+            all((out_dir / f"{ea_name}.{fmt}").is_file() for ea_name in ea_names)
+        if up_to_date:
+            print(f"{out_dir}: {fmt.upper()} data is up to date")
+    if not up_to_date:
+        out_dir.mkdir(parents=True, exist_ok=True)
+        if key_file.is_file():
+            key_file.unlink()
 
     jdata = dict()
+    streams = dict()
+    try:
+        for sample, sample_data in data.items():
+            group = groups[sample]
+            for ea, ea_values in sample_data.items():
+                ea_name = ea_to_name[ea]
+                measures = ea_values["measure"]
+                if not ea_name in jdata:
+                    jdata[ea_name] = {"count": 0, "max": dict()}
+                    for col in CATEGORICAL:
+                        jdata[ea_name][col] = {"levels": [], "codes": [], "lengths": []}
+                    if not up_to_date:
+                        streams[ea_name] = open(out_dir / f"{ea_name}.{fmt}", "w")
+                        if fmt == "csv":
+                            streams[ea_name].write("values," + ",".join(CATEGORICAL) + "\n")
+                        else:
+                            streams[ea_name].write('{"values":[')
+                info = jdata[ea_name]
+                if up_to_date:
+                    pass
+                elif fmt == "csv":
+                    suffix = "," + ",".join(map(csv_field, (group[0], sample, group[1], group[2])))
+                    streams[ea_name].write(''.join(f"{value!r}{suffix}\n"
+                                                   for value in measures.tolist()))
+                else:
+                    if info["count"]:
+                        streams[ea_name].write(',')
+                    streams[ea_name].write(','.join(map(repr, measures.tolist())))
+                info["count"] += len(measures)
+                info["max"][sample] = float(measures.max())
+                for col, value in zip(CATEGORICAL, (group[0], sample, group[1], group[2])):
+                    append_run(info[col], value, len(measures))
+
+        for ea_name, stream in streams.items():
+            if fmt == "csv":
+                continue
+            stream.write(']')
+            for col in CATEGORICAL:
+                stream.write(f',"{col}":')
+                json.dump(jdata[ea_name][col], stream, separators=(',', ':'))
+            stream.write('}')
+    finally:
+        for stream in streams.values():
+            stream.close()
+
+    if not up_to_date:
+        key_file.write_text(key)
+    return jdata
 
-    def process(sample, sample_data, group):
-        for ea, ea_values in sample_data.items():
-            ea_name = ea_to_name[ea]
-            if not ea_name in jdata:
-                jdata[ea_name] = {
-                    "values": [],
-                    "group": [],
-                    "sample": [],
-                    "corunner": [],
-                    "local": [],
-                }
-
-            for value in ea_values:
-                jdata[ea_name]["values"].append(value["measure"])
-                jdata[ea_name]["sample"].append(sample)
-                jdata[ea_name]["group"].append(group[0])
-                jdata[ea_name]["corunner"].append(group[1])
-                jdata[ea_name]["local"].append(group[2])
-
+def gen_json_dump(out_dir, jdata, output):
+    """
+    Gathers the per-EA files written by gen_json_data() in a single JSON
+    object indexed by EA name, that can be read back with mkdiff.py.
+    """
+    with open(output, "w") as outp:
+        outp.write('{')
+        for i, ea_name in enumerate(jdata):
+            outp.write(f'{"," if i else ""}{json.dumps(ea_name)}:')
+            with open(out_dir / f"{ea_name}.json") as inp:
+                copyfileobj(inp, outp)
+        outp.write('}')
+    store_summary(output, jdata)
+
+def summary_file(output):
+    # a.json => a.summary.json, next to the dump
+    return output.with_name(f"{output.stem}.summary.json")
+
+def store_summary(output, jdata):
+    """
+    Writes, next to a JSON dump, the number of measures and the maximum of
+    each sample of its EAs (as returned by gen_json_data()), along with the
+    identity of the dump they were taken from.
+    """
+    summary = {ea_name: {"count": info["count"], "max": info["max"]}
+               for ea_name, info in jdata.items()}
+    write_atomic(summary_file(output),
+                 json.dumps({"dump": file_identity(output), "eas": summary},
+                            separators=(',', ':')))
+
+def load_summary(output):
+    """
+    Returns the EAs of a JSON dump written by gen_json_dump(): their summary
+    if it was written for this very dump, the whole dump otherwise. Either
+    can be passed to ea_count() and sample_maxima().
+    """
+    output = Path(output)
+    try:
+        summary = load_json(summary_file(output))
+        if summary["dump"] == file_identity(output):
+            return summary["eas"]
+    except (OSError, ValueError, KeyError):
+        pass
+    return load_json(output)
+
+def expand_column(col):
+    """
+    Returns the list of values of a column of a per-EA file, whether it is
+    run-length encoded or not.
+    """
+    if isinstance(col, dict):
+        return [col["levels"][code]
+                for code, length in zip(col["codes"], col["lengths"])
+                for _ in range(length)]
+    return col
+
+def ea_count(info):
+    """
+    Number of measures of an EA, as returned by gen_json_data() or read from
+    a per-EA file.
+    """
+    return info["count"] if "count" in info else len(info["values"])
+
+def sample_maxima(info):
+    """
+    Maximum measure of each sample of an EA, as returned by gen_json_data()
+    or read from a per-EA file.
+    """
+    if "max" in info:
+        return info["max"]
+    maxima = dict()
+    for value, sample in zip(info["values"], expand_column(info["sample"])):
+        maxima[sample] = max(maxima.get(sample, value), value)
+    return maxima
+
+def jdata_digest(data, ea_to_name, groups, fmt):
+    """
+    Digest of everything the files written by gen_json_data() depend on: the
+    decoded measures (hence the dumps and the timer frequency), the groups
+    and the names of the EAs.
+    """
+    digest = hashlib.sha256(f"v{JDATA_FORMAT}:{fmt}".encode())
     for sample, sample_data in data.items():
-        process(sample, sample_data, groups[sample])
-
-    out_dir.mkdir(parents=True, exist_ok=True)
-    for ea_name, ea_data in jdata.items():
-        with open(out_dir / f"{ea_name}.json", "w") as stream:
-            json.dump(ea_data, stream, indent=2)
-    return jdata
+        digest.update(repr((sample, groups[sample])).encode())
+        for ea, ea_values in sample_data.items():
+            digest.update(repr(ea_to_name[ea]).encode())
+            digest.update(ea_values["measure"].tobytes())
+    return digest.hexdigest()
 
 
 # https://en.wikipedia.org/wiki/Relative_change_and_difference
 def calc(ref, value):
     return (value - ref) / ref * 100.0
 
+# Profile of the build: each step (psyko invocation, template, co-runner,
+# memory placement...) is timed by profile_step() and recorded here, with
+# the time it started (in seconds since PROFILE_START) and its duration.
+PROFILE = []
+PROFILE_LOCK = Lock()
+PROFILE_START = perf_counter()
+
+@contextmanager
+def profile_step(phase, name, **info):
+    """
+    Times the block it wraps as a step of the given phase. The block may
+    add details (e.g. retries, cache hits) to the dictionary it yields.
+    """
+    start = perf_counter()
+    try:
+        yield info
+    finally:
+        step = {
+            "phase": phase,
+            "name": str(name),
+            "start": start - PROFILE_START,
+            "duration": perf_counter() - start,
+            "thread": get_ident(),
+        }
+        step.update(info)
+        with PROFILE_LOCK:
+            PROFILE.append(step)
+
+def write_profile(path):
+    # One JSON object per line and per step
+    with open(path, "w") as stream:
+        for step in PROFILE:
+            stream.write(json.dumps(step) + "\n")
+
+def write_chrome_trace(path):
+    # Trace event format, as read by chrome://tracing or Perfetto
+    threads = dict()
+    events = []
+    for step in PROFILE:
+        tid = threads.setdefault(step["thread"], len(threads))
+        args = {k: v for k, v in step.items()
+                if k not in ("phase", "name", "start", "duration", "thread")}
+        events.append({
+            "name": step["name"],
+            "cat": step["phase"],
+            "ph": "X",
+            "ts": round(step["start"] * 1e6),
+            "dur": round(step["duration"] * 1e6),
+            "pid": getpid(),
+            "tid": tid,
+            "args": args,
+        })
+    with open(path, "w") as stream:
+        json.dump({"traceEvents": events}, stream)
+
+def print_profile_summary():
+    """
+    Prints, for each phase, the number of steps, their total and maximum
+    wall time, the retries and the cache hits.
+    """
+    phases = dict()
+    for step in PROFILE:
+        phase = phases.setdefault(step["phase"], [0, 0.0, 0.0, 0, 0])
+        phase[0] += 1
+        phase[1] += step["duration"]
+        phase[2] = max(phase[2], step["duration"])
+        phase[3] += step.get("retries", 0)
+        phase[4] += bool(step.get("cached", False))
+    lines = [f"{'phase':<20} {'steps':>6} {'total (s)':>10} {'max (s)':>9} {'retries':>8} {'cached':>7}"]
+    for name, (count, total, longest, retries, cached) in \
+            sorted(phases.items(), key=lambda item: -item[1][1]):
+        lines.append(f"{name:<20} {count:>6} {total:>10.3f} {longest:>9.3f} {retries:>8} {cached:>7}")
+    lines.append(f"wall time: {perf_counter() - PROFILE_START:.3f} s")
+    print('\n'.join(lines), file=stderr, flush=True)
+
+
+# psyko may be run from several threads at once (build.py --jobs): the output
+# of each invocation is buffered, and printed along with its command line
+# while holding this lock, so that commands do not interleave their output.
+PSYKO_LOCK = Lock()
+
+# Retry policy of psyko. Each subcommand has its own timeout, in seconds
+# (PSYKO_TIMEOUT_<SUBCOMMAND>, e.g. PSYKO_TIMEOUT_APP, or PSYKO_TIMEOUT for
+# the ones that are not listed below). A command that times out or fails to
+# get a license is tried again, at most PSYKO_MAX_ATTEMPTS times, after an
+# exponential backoff starting at PSYKO_BACKOFF seconds and capped at
+# PSYKO_BACKOFF_MAX seconds, with jitter.
+PSYKO_TIMEOUTS = {
+    "app": 300,
+    "partition": 120,
+    "gen-mem-conf": 60,
+}
+PSYKO_TIMEOUT = float(environ.get('PSYKO_TIMEOUT', '30'))
+PSYKO_MAX_ATTEMPTS = int(environ.get('PSYKO_MAX_ATTEMPTS', '10'))
+PSYKO_BACKOFF = float(environ.get('PSYKO_BACKOFF', '5'))
+PSYKO_BACKOFF_MAX = float(environ.get('PSYKO_BACKOFF_MAX', '300'))
+
+# When psyko fails to get a license, it must not be run by anyone before a
+# given date, stored in this file: all the builds (threads and processes)
+# back off together. Once that date is passed, a single command probes the
+# server while the others keep waiting, until it gets a license. Timeouts
+# only delay the command that timed out.
+LICENSE_GATE = Path(environ.get('PSYKO_LICENSE_GATE',
+    Path(environ.get('XDG_CACHE_HOME', Path.home() / '.cache')) / 'corunners' / 'license-gate'))
+
+# Statistics of the retries of psyko, printed by print_psyko_stats()
+PSYKO_STATS = {
+    "runs": 0,
+    "retries": 0,
+    "timeouts": 0,
+    "license_errors": 0,
+    "waited": 0.0,
+}
+
+def psyko_timeout(subcommand):
+    env = f"PSYKO_TIMEOUT_{subcommand.upper().replace('-', '_')}"
+    return float(environ.get(env, PSYKO_TIMEOUTS.get(subcommand, PSYKO_TIMEOUT)))
+
+# Set once the license gate was found unusable, so that it is reported once
+LICENSE_GATE_ERRORS = []
+
+def update_license_gate(update):
+    """
+    Calls update() with the date stored in the license gate (0 when it is
+    open), and stores the date it returns, if any, while the gate is locked.
+    If the gate cannot be used (e.g. its directory cannot be written), psyko
+    is run as if it was open.
+    """
+    try:
+        LICENSE_GATE.parent.mkdir(parents=True, exist_ok=True)
+        with open(LICENSE_GATE, 'a+') as gate:
+            fcntl.flock(gate, fcntl.LOCK_EX)
+            gate.seek(0)
+            try:
+                date = float(gate.read() or 0)
+            except ValueError:
+                date = 0.0
+            new_date = update(date)
+            if new_date is not None and new_date != date:
+                gate.seek(0)
+                gate.truncate()
+                gate.write(str(new_date))
+            return date
+    except OSError as e:
+        with PSYKO_LOCK:
+            if not LICENSE_GATE_ERRORS:
+                print(f"Cannot use the license gate {LICENSE_GATE}: {e}", file=stderr, flush=True)
+                LICENSE_GATE_ERRORS.append(e)
+        return 0.0
+
+def wait_license_gate(timeout):
+    """
+    Waits until psyko can be run. If the gate was closed, the caller probes
+    the license server: the gate stays closed for the others until the
+    probe ends (at most timeout seconds). Returns whether the caller probes.
+    """
+    waited = 0.0
+    while True:
+        now = time()
+        date = update_license_gate(lambda date: now + timeout if 0 < date <= now else None)
+        if date <= now:
+            break
+        delay = min(date - now, 5.0)
+        sleep(delay)
+        waited += delay
+    with PSYKO_LOCK:
+        PSYKO_STATS["waited"] += waited
+    return date > 0
+
+def close_license_gate(delay, probe=False):
+    # A failed probe replaces the date it set while probing
+    until = time() + delay
+    update_license_gate(lambda date: until if probe else max(date, until))
+
+def open_license_gate():
+    update_license_gate(lambda date: 0.0 if date else None)
+
+def print_psyko_stats():
+    with PSYKO_LOCK:
+        print(f"psyko: {PSYKO_STATS['runs']} runs, {PSYKO_STATS['retries']} retries "
+              f"({PSYKO_STATS['timeouts']} timeouts, {PSYKO_STATS['license_errors']} license errors), "
+              f"{PSYKO_STATS['waited']:.1f}s waiting for the license server",
+              file=stderr, flush=True)
+
 def psyko(conf, *cmd_args):
     cmd = [
         conf['psyko'],
@@ -199,36 +756,141 @@ def psyko(conf, *cmd_args):
         "--product", conf['product'],
         '--color', 'yes',
     ] + [*cmd_args]
-    print("[RUN] ", end='')
-    for item in cmd:
-        print(f"'{item}' ", end='')
-    print()
-
-    # Run psyko... This is run in an infinite loop to handle timeouts...
-    # This is especially annoying when you have a weak network connection and
-    # that you fail to request a License. Since running all tests to collect
-    # measures is quite slow, failing because of a timeout on such problems
-    # is quite unpleasant.
-    # So, in case of a network error (highly suggested by the timeout), we
-    # just try again. It's kind of a kludge, but actually saved to much
-    # time.
+    header = "[RUN] " + ''.join(f"'{item}' " for item in cmd)
+    timeout = psyko_timeout(str(cmd_args[0]))
+
+    def report(out, err):
+        with PSYKO_LOCK:
+            print(header, flush=True)
+            if out:
+                print(out, end='', flush=True)
+            print(err, file=stderr, flush=True)
+
+    # Run psyko... Timeouts and license errors are retried: since running
+    # all tests to collect measures is quite slow, failing because of a
+    # network error or of the license server is quite unpleasant.
+    # Other errors are fatal.
+    # Returns None if psyko succeeded, else "timeout" or "license".
     def run_cmd(cmd):
         try:
-            print(run( cmd, timeout=30, cwd=conf['cwd'], check=True,
-              universal_newlines=True, stderr=PIPE).stderr, file=stderr)
-            return True
+            proc = run( cmd, timeout=timeout, cwd=conf['cwd'], check=True,
+              universal_newlines=True, stdout=PIPE, stderr=PIPE)
+            report(proc.stdout, proc.stderr)
+            return None
         except TimeoutExpired:
-            return False
+            report('', f'timed out after {timeout:g} seconds')
+            with PSYKO_LOCK:
+                PSYKO_STATS["timeouts"] += 1
+            return "timeout"
         except CalledProcessError as e:
             err = e.stderr
-            lmapi = 'Unknown LMAPI error' in err
-            print(err, file=stderr)
-            if lmapi:
-              print('retrying in 60 seconds', file=stderr)
-              sleep(60)
-              return False
+            report(e.stdout, err)
+            if 'Unknown LMAPI error' in err:
+              with PSYKO_LOCK:
+                  PSYKO_STATS["license_errors"] += 1
+              return "license"
             else:
               exit("Failed to run psyko")
 
-    while not run_cmd(cmd):
-        pass
+    with PSYKO_LOCK:
+        PSYKO_STATS["runs"] += 1
+    output = next((cmd_args[i + 1] for i, arg in enumerate(cmd_args[:-1])
+                   if arg in ("-o", "-b")), cmd_args[-1])
+    with profile_step(f"psyko {cmd_args[0]}", Path(output).name) as step:
+        for attempt in range(PSYKO_MAX_ATTEMPTS):
+            step["retries"] = attempt
+            if attempt:
+                with PSYKO_LOCK:
+                    PSYKO_STATS["retries"] += 1
+            retry = attempt + 1 < PSYKO_MAX_ATTEMPTS
+            delay = min(PSYKO_BACKOFF * 2 ** attempt, PSYKO_BACKOFF_MAX)
+            delay = random.uniform(delay / 2, delay)
+            failure = "fatal"
+            probe = wait_license_gate(timeout)
+            try:
+                failure = run_cmd(cmd)
+            finally:
+                # Only a license error that is retried closes the gate. In
+                # any other case, the gate this command probes is opened
+                # again, so that the others do not wait for nothing.
+                if failure == "license" and retry:
+                    close_license_gate(delay, probe)
+                elif failure is None or probe:
+                    open_license_gate()
+            if failure is None:
+                return
+            if retry:
+                with PSYKO_LOCK:
+                    print(f"retrying in {delay:.1f} seconds", file=stderr, flush=True)
+                # After a license error, the gate makes this command wait,
+                # if it can be used
+                if failure == "timeout" or LICENSE_GATE_ERRORS:
+                    sleep(delay)
+    exit(f"Failed to run psyko after {PSYKO_MAX_ATTEMPTS} attempts")
+
+
+# Objects compiled by psyko are cached on disk, in a directory shared by all
+# the build directories (which the run scripts wipe before each build).
+# Entries are addressed by the content of everything the compilation depends
+# on: the source, its configuration, the headers it may include, the product,
+# and the identity of psyko and of the RTK.
+OBJ_CACHE_DIR = Path(environ.get('OBJ_CACHE_DIR',
+    Path(environ.get('XDG_CACHE_HOME', Path.home() / '.cache')) / 'corunners' / 'objects'))
+NO_OBJ_CACHE = bool(environ.get('NO_OBJ_CACHE', ''))
+
+def psyko_cache_key(conf, name, paths, build_dir=None, keys=()):
+    # Digest of the content of the given files, for the given product and
+    # step, with the same psyko and RTK. Generated files may refer to the
+    # build directory: it is left out of the digest. Inputs that have a
+    # cache key of their own (e.g. objects) are given by their keys.
+    psyko_bin = which(conf['psyko']) or conf['psyko']
+    key = hashlib.sha256()
+    for item in (name, conf['product'], file_identity(psyko_bin),
+                 file_identity(conf['rtk_dir']), *keys):
+        key.update(f"{item}\0".encode())
+    for path in paths:
+        content = Path(path).read_bytes()
+        if build_dir is not None:
+            content = content.replace(str(build_dir).encode(), b"${build_dir}")
+        key.update(content)
+        key.update(b"\0")
+    return key.hexdigest()
+
+def psyko_object(conf, subcommand, source, config, output, deps=()):
+    """
+    Runs "psyko <subcommand> <source> <config> -o <output>", unless the
+    object cache already holds the output of the very same compilation.
+    Returns the cache key of the output: unlike its content, it does not
+    depend on the build directory.
+    """
+    digest = psyko_cache_key(conf, subcommand, [source, config, *deps])
+    if NO_OBJ_CACHE:
+        psyko(conf, subcommand, source, config, "-o", output)
+        return digest
+    cache_file = OBJ_CACHE_DIR / digest[:2] / digest
+    if cache_file.is_file():
+        try:
+            with profile_step(f"psyko {subcommand}", Path(output).name, cached=True):
+                copyfile(cache_file, output)
+        except OSError as e:
+            # e.g. an entry that another user of the cache did not let us read
+            print(f"Cannot read {cache_file}: {e}", file=stderr)
+        else:
+            with PSYKO_LOCK:
+                print(f"[CACHED] '{output}'", flush=True)
+            return digest
+    psyko(conf, subcommand, source, config, "-o", output)
+    copy_atomic(output, cache_file)
+    return digest
+
+def copy_atomic(src, dst):
+    # Same as write_atomic(), for a copy of the file src
+    try:
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile('wb', dir=dst.parent, delete=False) as stream:
+            with open(src, 'rb') as inp:
+                copyfileobj(inp, stream)
+            publish(stream)
+        replace(stream.name, dst)
+    except OSError as e:
+        print(f"Cannot write {dst}: {e}", file=stderr)
@@ -12,6 +12,7 @@ FLASHLIKE = ['FLASH', 'U']
 TOP_DIR = __main__.Path(__main__.__file__).parent.resolve()
 PSY_DIR = TOP_DIR / "psy"
 SRC_DIR = TOP_DIR / "src"
+INC_DIR = TOP_DIR / "include"
 CFG_DIR = TOP_DIR / "config"
 STUBS_DIR = TOP_DIR / "psy" / "stubs"
 
@@ -26,6 +27,10 @@ class Help:
     OUTPUT = "Path where the executable is to be generated"
     PRODUCT = "Name of the ASTERIOS RTK Product"
     MEM_CONF = "If set, this argument is a json file used to generate the memory placement"
+    JOBS = "Number of sources compiled concurrently"
+    PROFILE = "Path of a file where the duration of each step of the build is recorded (as JSON lines)"
+    CHROME_TRACE = "Path of a file where the steps of the build are recorded in the Chrome trace event format"
+    RELINK_FROM = "Path to the build directory of the same configuration, without memory placement: its partition and memory report are reused to only generate the memory placement (--mem-conf) and link the executable"
 
 AGENT_CONFIG_HJSON_TEMPLATE = """
 {
@@ -0,0 +1,71 @@
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from scripts.kmem import gen_kmem, check_kmem
+
+MEMREPORT = {"sections": [
+    {"name": "t", "size": 0x1000, "address": 0x10000, "type": "TEXT", "id_name": "task_A"},
+    {"name": "c", "size": 0x1000, "address": 0x13000, "type": "TEXT", "id_name": ""},
+    {"name": "d", "size": 0x100, "address": 0x13800, "type": "DATA", "id_name": ""},
+]}
+
+def kmemory(c, d):
+    # c and d are in the same domain: d overlaps c when d < c + 0x1000
+    return {"kmemory": {"regions": [{
+        "name": "ram", "physical_address": 0x10000, "size": 0x10000,
+        "domains": [
+            {"output_sections": [{"name": "t", "physical_address": 0x10000}]},
+            {"output_sections": [{"name": "c", "physical_address": c},
+                                 {"name": "d", "physical_address": d}]},
+        ],
+    }]}}
+
+def place_task(address):
+    return {"elements": [{"type": "task", "names": ["task_A"],
+                          "sections": [{"names": ["TEXT"], "address": address}]}]}
+
+def test_default_conflicts():
+    conflicts = check_kmem(kmemory(0x13000, 0x13800), MEMREPORT)
+    assert [(c.kind, c.names) for c in conflicts] == [("overlap", ("c", "d"))]
+
+def test_relocated_conflict_is_known():
+    # The placement of the task moves c and d, which still overlap, at other
+    # addresses: it is the conflict of the default kmemory, not a new one
+    default = kmemory(0x13000, 0x13800)
+    kmem = gen_kmem(place_task(0x12c00), MEMREPORT, default)
+    assert check_kmem(kmem, MEMREPORT)
+    assert check_kmem(kmem, MEMREPORT, default) == []
+
+def test_new_conflict():
+    default = kmemory(0x13000, 0x14000)
+    kmem = kmemory(0x13000, 0x13800)
+    conflicts = check_kmem(kmem, MEMREPORT, default)
+    assert [(c.kind, c.names) for c in conflicts] == [("overlap", ("c", "d"))]
+
+def test_overlaps_every_section():
+    # d overlaps both c and t, whatever the order of their ends
+    kmem = kmemory(0x13000, 0x13800)
+    kmem["kmemory"]["regions"][0]["domains"][0]["output_sections"][0]["physical_address"] = 0x13400
+    names = {c.names for c in check_kmem(kmem, MEMREPORT) if c.kind == "overlap"}
+    assert names == {("c", "t"), ("c", "d"), ("d", "t")}
+
+def test_alignment_is_a_power_of_two():
+    kmem = kmemory(0x13000, 0x13808)
+    d = kmem["kmemory"]["regions"][0]["domains"][1]["output_sections"][1]
+    d["alignment"] = 4
+    assert [c.message for c in check_kmem(kmem, MEMREPORT) if c.kind == "alignment"] == \
+        ["d at 0x13808 is not aligned on 0x10"]
+    d["alignment"] = 3
+    assert [c for c in check_kmem(kmem, MEMREPORT) if c.kind == "alignment"] == []
+
+def test_placement_alignment():
+    # The task is moved to the next multiple of 2**5 bytes
+    default = kmemory(0x14000, 0x15000)
+    t = default["kmemory"]["regions"][0]["domains"][0]["output_sections"][0]
+    t["alignment"] = 5
+    kmem = gen_kmem(place_task(0x12004), MEMREPORT, default)
+    domains = kmem["kmemory"]["regions"][0]["domains"]
+    assert domains[0]["output_sections"][0]["physical_address"] == 0x12020
+    assert check_kmem(kmem, MEMREPORT, default) == []